@@ -0,0 +1,94 @@
+"""
+Микробенчмарк разбора произвольных полей сделки Kommo.
+
+Сравнивает скомпилированный план AmoAPI._extract_all_custom_fields с прежним
+линейным поиском next(...) по custom_fields_values и if-цепочкой по типам.
+Запуск из корня проекта: python -m benchmarks.bench_custom_fields
+"""
+import json
+import os
+import re
+import timeit
+import zoneinfo
+from datetime import datetime
+
+from config import amo_api
+from src.models.document import ExtraDocument
+
+LEADS_PATH = os.path.join(os.path.dirname(__file__), "data", "leads.json")
+ROUNDS = 2000
+
+
+def legacy_docdict(field, lines: str, default=None):
+    doc_dict = {}
+    for line in lines.strip().split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+        match = re.compile(r"^\s*\[([^\]]+)\]\s*(.*?)\s*$").match(line)
+        if match:
+            doc_dict[match.group(1).strip()] = ExtraDocument(id=match.group(1).strip(), title=match.group(1).strip(),
+                                                             description=match.group(2).strip(), is_uploaded=False)
+    return doc_dict
+
+
+def legacy_datetime(field, timestamp):
+    return datetime.fromtimestamp(int(timestamp), tz=zoneinfo.ZoneInfo("Asia/Qatar"))
+
+
+LEGACY_CONVERTERS = {"docs_extra": legacy_docdict, "exam_datetime": legacy_datetime}
+
+
+def legacy_extract(lead_raw) -> dict:
+    """Прежняя реализация: O(полей × значений) и выбор экстрактора на каждом поле"""
+    result = {}
+    custom_data = lead_raw.get("custom_fields_values") or []
+
+    for field in amo_api.custom_fields.values():
+        field_data = next((f for f in custom_data if f["field_id"] == field.id), None)
+
+        if field_data is None:
+            result[field.key] = field.default
+            continue
+        elif field.type == str:
+            value = field_data["values"][0]['value']
+        elif field.type == list:
+            value = [element["value"] for element in field_data["values"]]
+        elif field.type == bool:
+            value = field_data["values"][0]['value']
+        elif field.type == datetime:
+            value = field_data["values"][0]['value']
+        else:
+            value = field_data
+
+        convert = LEGACY_CONVERTERS.get(field.key, field.convert)
+        result[field.key] = convert(field, value) if convert is not None else value
+
+    return result
+
+
+def main():
+    with open(LEADS_PATH, encoding="utf-8") as f:
+        leads: list[dict] = json.load(f)
+
+    assert [legacy_extract(lead) for lead in leads] == [amo_api._extract_all_custom_fields(lead) for lead in leads]
+
+    def run_legacy():
+        for lead in leads:
+            legacy_extract(lead)
+
+    def run_compiled():
+        for lead in leads:
+            amo_api._extract_all_custom_fields(lead)
+
+    total = ROUNDS * len(leads)
+    legacy = min(timeit.repeat(run_legacy, number=ROUNDS, repeat=3)) / total * 1e6
+    compiled = min(timeit.repeat(run_compiled, number=ROUNDS, repeat=3)) / total * 1e6
+
+    print(f"Сделок в выборке: {len(leads)}, полей в сделке: {len(leads[0]['custom_fields_values'])}")
+    print(f"Прежний разбор:      {legacy:8.2f} мкс/сделка")
+    print(f"Скомпилированный план: {compiled:6.2f} мкс/сделка  (x{legacy / compiled:.1f})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+Бенчмарк задержки event loop во время рендера превью PDF: рендер прямо в loop против пула процессов.
+
+Пока идут несколько рендеров тяжелого PDF, тикер спит по 10 мс и замеряет, насколько позже
+он просыпается. Это и есть задержка, которую в этот момент видят все остальные запросы.
+Запуск из корня проекта: python -m benchmarks.bench_preview_loop
+"""
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+import fitz
+
+from src.classes.pdf_thumbnail import render_pdf_thumbnail
+from src.classes.preview_renderer import PreviewRenderer
+
+RENDERS = 6
+WIDTH = 1240  # A4 при 150 dpi
+TICK = 0.01
+
+
+def make_heavy_pdf(path: str):
+    """PDF со страницей, плотно забитой векторной графикой – аналог большого скана"""
+    with fitz.open() as pdf_document:
+        page = pdf_document.new_page(width=595, height=842)
+        shape = page.new_shape()
+        for i in range(3000):
+            shape.draw_circle(((i * 37) % 580, (i * 53) % 830), 3 + i % 9)
+            shape.finish(color=(i % 3 / 2, 0.3, 0.6), fill=(0.9, i % 5 / 4, 0.2))
+        shape.commit()
+        pdf_document.save(path)
+
+
+async def measure_lag(render_all) -> tuple[float, float, float]:
+    """Возвращает (время рендеров, p95 задержки, max задержки) в секундах"""
+
+    lags: list[float] = []
+    done = asyncio.Event()
+
+    async def ticker():
+        while not done.is_set():
+            started_at = time.perf_counter()
+            await asyncio.sleep(TICK)
+            lags.append(time.perf_counter() - started_at - TICK)
+
+    ticker_task = asyncio.create_task(ticker())
+    await asyncio.sleep(TICK * 5)
+
+    started_at = time.perf_counter()
+    await render_all()
+    elapsed = time.perf_counter() - started_at
+
+    done.set()
+    await ticker_task
+    return elapsed, statistics.quantiles(lags, n=20, method="inclusive")[-1], max(lags)
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as folder:
+        pdf_path = os.path.join(folder, "heavy.pdf")
+        make_heavy_pdf(pdf_path)
+
+        async def render_inline():
+            async def render():
+                render_pdf_thumbnail(pdf_path, 0, WIDTH, "webp", 80)
+            await asyncio.gather(*(render() for _ in range(RENDERS)))
+
+        renderer = PreviewRenderer(max_workers=2, timeout=120)
+        await renderer.render(pdf_path, WIDTH)  # Прогрев пула: запуск процессов не должен попасть в замер
+
+        async def render_pool():
+            previews = await asyncio.gather(*(renderer.render(pdf_path, WIDTH) for _ in range(RENDERS)))
+            assert all(previews)
+
+        try:
+            for title, render_all in (("В event loop", render_inline), ("В пуле процессов", render_pool)):
+                elapsed, p95, worst = await measure_lag(render_all)
+                print(f"{title:17} рендеров: {RENDERS}  время: {elapsed * 1000:7.0f} мс  "
+                      f"задержка loop p95: {p95 * 1000:6.1f} мс  max: {worst * 1000:6.1f} мс")
+        finally:
+            renderer.shutdown()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,136 @@
+"""
+Бенчмарк рендера страницы профиля на сделках из benchmarks/data/leads.json и синтетическом каталоге.
+
+Сравнивает прежний рендер (все секции через {% include %}, markdown.markdown() на каждый вызов фильтра)
+с текущим: кеш фрагментов секций и LRU для markdown. Текущий рендер меряется дважды – первый заход
+клиента (кеши пустые) и повторный (секции из кеша).
+Запуск из корня проекта: python -m benchmarks.bench_render
+"""
+import json
+import os
+import timeit
+from datetime import datetime, timedelta, timezone
+from types import MappingProxyType
+
+import markdown
+
+from config import amo_api
+from src.classes.gas.gas_api import CatalogSnapshot
+from src.dependencies import templates, gas_api, fragment_cache
+from src.models.customer import Customer
+from src.models.document import Document, UploadedDocument
+from src.models.faq import FAQ
+from src.models.group import Group, GroupEvent, Person
+from src.models.speciality import Speciality
+from src.routes.profile import section_versions
+from src.utils import markdown_to_html
+
+LEADS_PATH = os.path.join(os.path.dirname(__file__), "data", "leads.json")
+ROUNDS = 200
+
+# pages/profile.html до кеша фрагментов
+LEGACY_PROFILE = """
+{% extends "base.html" %}
+{% block content %}
+      {% include 'sections/welcome.html' %}
+      {% include 'sections/status.html' %}
+      {% include 'sections/group.html' %}
+      {% if customer.has_full_support %}
+          {% include 'sections/docs.html' %}
+          {% include 'sections/docs_extra.html' %}
+      {% endif %}
+      {% include 'sections/events.html' %}
+      {% include 'sections/exams.html' %}
+      {% include 'sections/accounts.html' %}
+{% endblock %}
+"""
+
+
+def build_catalog() -> CatalogSnapshot:
+    now = datetime.now(timezone.utc)
+    person = Person(name="Имя Фамилия", role="Куратор", avatar="/static/img/avatar.png", tg="https://t.me/x")
+    events = tuple(GroupEvent(title=f"Занятие {i}", description="Разбор вопросов", link="https://zoom.us/j/1",
+                              starts=now + timedelta(days=i - 10), ends=now + timedelta(days=i - 10, hours=1))
+                   for i in range(40))
+    documents = {i: Document(id=i, title=f"Документ {i}", description="Описание документа", guide="<p>Гайд</p>")
+                 for i in range(1, 21)}
+    specialities = {i: Speciality(id=i, title=f"Специальность {i}", docs_required=tuple(range(i, i + 10)),
+                                  description="") for i in range(1, 11)}
+    groups = {f"G{i}": Group(id=f"G{i}", chat_tg="https://t.me/group", curator=person, teacher=person, expert=person,
+                             events=events) for i in range(1, 50)}
+    return CatalogSnapshot(
+        config=MappingProxyType({"text_welcome": "Добро пожаловать", "link_offer_ru": "https://volna.me/offer"}),
+        specialities=MappingProxyType(specialities),
+        documents=MappingProxyType(documents),
+        faq=tuple(FAQ(question=f"Вопрос {i}", answer="Ответ") for i in range(30)),
+        groups=MappingProxyType(groups),
+        version="bench",
+    )
+
+
+def build_profiles(leads: list[dict]) -> list[tuple[dict, list[UploadedDocument]]]:
+    """Собирает клиента так же, как обработчик /profile/{amo_id}"""
+    profiles = []
+    for lead in leads:
+        customer: Customer = amo_api._build_customer(lead, {"first_name": "Анна", "full_name": "Анна Б"})
+        customer.faq = gas_api.faq
+        customer.group = gas_api.get_group(customer.group_id)
+        customer.specialty = gas_api.get_specialty(customer.specialty_id)
+        customer.docs = gas_api.get_documents_by_indices(customer.specialty.docs_required, customer.docs_ready)
+
+        uploads = [UploadedDocument(id=n, customer_id=customer.amo_id, doc_id=doc_id, gdrive_id=f"gd{customer.amo_id}_{n}",
+                                    created_at=datetime.now(timezone.utc), is_extra=False)
+                   for n, doc_id in enumerate(customer.specialty.docs_required[:3])]
+        customer.set_uploads(uploads)
+
+        context = {"customer": customer, "amo_id": customer.amo_id, "config": gas_api.config}
+        profiles.append((context, uploads))
+    return profiles
+
+
+def main():
+    with open(LEADS_PATH, encoding="utf-8") as f:
+        leads: list[dict] = json.load(f)
+
+    gas_api.catalog = build_catalog()
+    profiles = build_profiles(leads)
+
+    legacy_env = templates.env.overlay()
+    legacy_env.template_class = templates.env.template_class
+    legacy_env.filters["markdown"] = markdown.markdown
+    legacy_template = legacy_env.from_string(LEGACY_PROFILE)
+    template = templates.env.get_template("pages/profile.html")
+
+    def render_legacy():
+        for context, _ in profiles:
+            legacy_template.render(context)
+
+    def render_current():
+        for context, uploads in profiles:
+            versions = section_versions(context["customer"], uploads, gas_api.catalog.version)
+            template.render(context | {"versions": versions})
+
+    def render_cold():
+        fragment_cache.cache.clear()
+        markdown_to_html.cache_clear()
+        render_current()
+
+    total = ROUNDS * len(profiles)
+    legacy = min(timeit.repeat(render_legacy, number=ROUNDS, repeat=3)) / total * 1000
+    cold = min(timeit.repeat(render_cold, number=ROUNDS, repeat=3)) / total * 1000
+    render_current()
+    warm = min(timeit.repeat(render_current, number=ROUNDS, repeat=3)) / total * 1000
+
+    exam_info = profiles[0][0]["customer"].exam_info
+    md_legacy = min(timeit.repeat(lambda: markdown.markdown(exam_info), number=ROUNDS, repeat=3)) / ROUNDS * 1e6
+    md_cached = min(timeit.repeat(lambda: markdown_to_html(exam_info), number=ROUNDS, repeat=3)) / ROUNDS * 1e6
+
+    print(f"Профилей в выборке: {len(profiles)}")
+    print(f"Прежний рендер:            {legacy:6.3f} мс/профиль")
+    print(f"С кешами, первый заход:    {cold:6.3f} мс/профиль  (x{legacy / cold:.1f})")
+    print(f"С кешами, повторный заход: {warm:6.3f} мс/профиль  (x{legacy / warm:.1f})")
+    print(f"Фильтр markdown для exam_info: {md_legacy:.1f} мкс -> {md_cached:.2f} мкс")
+
+
+if __name__ == "__main__":
+    main()
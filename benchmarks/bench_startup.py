@@ -0,0 +1,51 @@
+"""
+Бенчмарк холодного старта каталога: загрузка из гугл-таблиц против загрузки снимка с диска.
+
+Сначала делает обычный preload из Apps Script (нужен доступ в интернет) и сохраняет снимок,
+затем несколько раз поднимает каталог из этого снимка свежим GDriveFetcher.
+Запуск из корня проекта: python -m benchmarks.bench_startup
+"""
+import asyncio
+import os
+import tempfile
+import time
+
+from config import http_transports
+from src.classes.gas.gas_api import GDriveFetcher
+
+ROUNDS = 20
+
+
+async def remote_boot(snapshot_path: str) -> float:
+    fetcher = GDriveFetcher(snapshot_path=snapshot_path, transports=http_transports)
+    started_at = time.perf_counter()
+    await fetcher.preload()
+    return time.perf_counter() - started_at
+
+
+def snapshot_boot(snapshot_path: str) -> float:
+    fetcher = GDriveFetcher(snapshot_path=snapshot_path)
+    started_at = time.perf_counter()
+    assert fetcher.load_snapshot()
+    return time.perf_counter() - started_at
+
+
+def main():
+    with tempfile.TemporaryDirectory() as folder:
+        snapshot_path = os.path.join(folder, "catalog.snapshot")
+
+        try:
+            remote = asyncio.run(remote_boot(snapshot_path))
+        except Exception as error:
+            print(f"Не удалось загрузить каталог из Apps Script: {error!r}")
+            return
+
+        snapshot = min(snapshot_boot(snapshot_path) for _ in range(ROUNDS))
+
+        print(f"Размер снимка: {os.path.getsize(snapshot_path) / 1024:.1f} кб")
+        print(f"Старт из Apps Script: {remote * 1000:9.1f} мс")
+        print(f"Старт из снимка:      {snapshot * 1000:9.1f} мс  (x{remote / snapshot:.0f})")
+
+
+if __name__ == "__main__":
+    main()
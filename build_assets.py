@@ -0,0 +1,10 @@
+"""
+Сборка статики при деплое: хешированные имена, .gz и .br варианты и manifest.json.
+Запуск из корня проекта: python build_assets.py
+"""
+from config import STATIC_FOLDER, STATIC_BUILD_FOLDER, logger
+from src.classes.static_assets import build_assets
+
+if __name__ == "__main__":
+    manifest = build_assets(STATIC_FOLDER, STATIC_BUILD_FOLDER)
+    logger.info(f"Статика: Собрано файлов: {len(manifest)} в {STATIC_BUILD_FOLDER}")
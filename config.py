@@ -6,6 +6,8 @@ from loguru import logger
 
 from src.classes.amo.amoapi import AmoAPI
 from src.classes.amo.amoapi import FieldConverter as FC
+from src.classes.http_transports import HttpTransports, UpstreamConfig
+from src.classes.metrics import MetricsRegistry
 from src.classes.tg.tg_logger import TGLogger
 
 # GAS CONFIGS
@@ -20,6 +22,36 @@ FAQ_URL = GDRIVE_URL + "/faq"
 GROUPS_URL = GDRIVE_URL + "/groups"
 EVENTS_URL = GDRIVE_URL + "/events"
 CONFIG_URL = GDRIVE_URL + "/config"
+CATALOG_REFRESH_INTERVAL = int(os.getenv("CATALOG_REFRESH_INTERVAL", 600))  # Раз в сколько секунд обновляем каталог, 0 – никогда
+
+# LOCAL STORAGE CONFIGS
+
+DATA_FOLDER = os.getenv("DATA_FOLDER", "var")  # Служебные файлы приложения, в отличие от uploads не раздаются наружу
+CATALOG_SNAPSHOT_PATH = os.path.join(DATA_FOLDER, "catalog.snapshot")
+PREVIEWS_FOLDER = os.path.join(DATA_FOLDER, "previews")  # Исходники загрузок и их миниатюры по хешу содержимого
+
+# STATIC CONFIGS
+
+STATIC_FOLDER = "static"
+STATIC_BUILD_FOLDER = os.getenv("STATIC_BUILD_FOLDER", "build/static")  # Результат python build_assets.py
+
+# JOBS CONFIGS
+
+JOBS_DB_PATH = os.path.join(DATA_FOLDER, "jobs.sqlite3")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))  # Сколько фоновых задач выполняем одновременно
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", 5))
+JOB_LEASE = int(os.getenv("JOB_LEASE", 60))  # Секунд без продления, после которых задачу упавшего воркера заберут другие
+JOB_DELIVERY_TIMEOUT = float(os.getenv("JOB_DELIVERY_TIMEOUT", 120))  # Сколько задача ждет доставки отчета, дальше – повтор
+
+# TEMPLATE CONFIGS
+
+APP_ENV = os.getenv("APP_ENV", "production")  # development – шаблоны перечитываются при изменении файлов
+TEMPLATES_FOLDER = "src/templates"
+TEMPLATES_AUTO_RELOAD = APP_ENV == "development"
+TEMPLATES_BYTECODE_FOLDER = os.path.join(DATA_FOLDER, "jinja")  # Скомпилированные шаблоны, общие для всех воркеров
+FRAGMENT_CACHE_TTL = int(os.getenv("FRAGMENT_CACHE_TTL", 60 * 60))  # Сколько секунд держим готовые секции страниц
+FRAGMENT_CACHE_SIZE = int(os.getenv("FRAGMENT_CACHE_SIZE", 5000))
+MARKDOWN_CACHE_SIZE = int(os.getenv("MARKDOWN_CACHE_SIZE", 2000))  # Сколько разных текстов из Kommo держим готовым HTML
 
 # TIMEZONE CONFIGS
 
@@ -31,22 +63,80 @@ AMO_BASE_URL = "https://xeniaceo.kommo.com"
 AMO_ACCESS_TOKEN = os.getenv("AMO_ACCESS_TOKEN")
 OPERATIONAL_FUNNEL_ID = 9490932
 AMO_REPORT_URL = "https://hooks.tglk.ru/in/BJDvgNxVN9evDeC81ZU3zx7m6Gzw35"
+AMO_LEAD_CACHE_TTL = int(os.getenv("AMO_LEAD_CACHE_TTL", 60))  # Сколько секунд сделка живет в кеше
+AMO_LEAD_CACHE_SIZE = int(os.getenv("AMO_LEAD_CACHE_SIZE", 1000))  # Сколько сделок держим в кеше
+AMO_CONTACT_CACHE_TTL = int(os.getenv("AMO_CONTACT_CACHE_TTL", 24 * 60 * 60))  # Имена контактов почти не меняются
+AMO_CONTACT_CACHE_SIZE = int(os.getenv("AMO_CONTACT_CACHE_SIZE", 5000))
+AMO_RATE_LIMIT = float(os.getenv("AMO_RATE_LIMIT", 7))  # Лимит Kommo – около 7 запросов в секунду на аккаунт
+AMO_RATE_BURST = int(os.getenv("AMO_RATE_BURST", 7))
+AMO_MAX_RETRIES = int(os.getenv("AMO_MAX_RETRIES", 3))  # Повторы на 429 и 5xx
+AMO_REPORT_QUEUE_SIZE = int(os.getenv("AMO_REPORT_QUEUE_SIZE", 1000))  # Сколько событий для АМО держим в очереди
+AMO_REPORT_BATCH_SIZE = int(os.getenv("AMO_REPORT_BATCH_SIZE", 1))  # Больше 1 – только если вебхук принимает список
+AMO_REPORT_MAX_RETRIES = int(os.getenv("AMO_REPORT_MAX_RETRIES", 5))
 
 # UPLOAD CONFIGS
 
 ALLOWED_EXTENSIONS = ["pdf"]
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE", 20 * 1024 * 1024))  # Максимальный размер одного файла, байт
+UPLOAD_CHUNK_SIZE = 3 * 64 * 1024  # Читаем и кодируем в Base64 кусками, кратными трем байтам
+UPLOAD_REQUEST_CONCURRENCY = int(os.getenv("UPLOAD_REQUEST_CONCURRENCY", 3))  # Файлов одного запроса грузим одновременно
+UPLOAD_GLOBAL_CONCURRENCY = int(os.getenv("UPLOAD_GLOBAL_CONCURRENCY", 8))  # Файлов на GAS одновременно со всего приложения
+UPLOADS_CACHE_TTL = int(os.getenv("UPLOADS_CACHE_TTL", 300))  # Сколько секунд держим список загрузок клиента
+UPLOADS_CACHE_SIZE = int(os.getenv("UPLOADS_CACHE_SIZE", 1000))
+UPLOADS_DB_PATH = os.path.join(DATA_FOLDER, "uploads.sqlite3")  # Поколения загрузок клиентов, общие для всех воркеров
 UPLOAD_FOLDER = "uploads"
-logger.add(UPLOAD_FOLDER + "/file_{time}.log", rotation="12:00")
+
+PREVIEW_WORKERS = int(os.getenv("PREVIEW_WORKERS", 2))  # Процессов для рендера превью PDF
+PREVIEW_SIZES = {"small": 240, "medium": 720}  # Ширина миниатюр в пикселях
+PREVIEW_FORMAT = os.getenv("PREVIEW_FORMAT", "webp")  # webp или jpeg
+PREVIEW_QUALITY = int(os.getenv("PREVIEW_QUALITY", 80))
+PREVIEW_PAGE = int(os.getenv("PREVIEW_PAGE", 0))  # Какую страницу PDF показываем в превью
+PREVIEW_TIMEOUT = float(os.getenv("PREVIEW_TIMEOUT", 10))  # Секунд на рендер, дальше показываем заглушку
+PREVIEW_PLACEHOLDER = "static/img/preview_placeholder.png"
+LOG_FILE = UPLOAD_FOLDER + "/file_{time}.log"  # Файловый лог подключается при старте приложения, а не при импорте
 
 # TELEGRAM CONFIGS
 
 TELEGRAM_BOT_TOKEN=os.getenv("TG_BOT_TOKEN")
 TELEGRAM_CHAT_ID=os.getenv("TG_CHAT_ID")
 TELEGRAM_LOG_LEVEL="WARNING"
+TELEGRAM_CHAT_INTERVAL = float(os.getenv("TG_CHAT_INTERVAL", 3))  # Не чаще сообщения в N секунд в один чат
+TELEGRAM_DIGEST_WINDOW = float(os.getenv("TG_DIGEST_WINDOW", 0))  # Собирать отчеты о загрузках за N секунд, 0 – не собирать
+
+# ADMIN CONFIGS
+
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # Без токена профилирование (?profile=1) и ручки /metrics, /stats/*, /warmup/* закрыты
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", 0.001))  # Шаг семплирования профайлера, с
+
+# HTTP CONFIGS
+
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "1") == "1"  # Нужен пакет h2, без него остается HTTP/1.1
+
+# Соединения с каждым внешним сервисом: свой пул, keep-alive и таймауты
+UPSTREAMS = {
+    "kommo": UpstreamConfig(max_connections=AMO_RATE_BURST * 2, max_keepalive=AMO_RATE_BURST, keepalive_expiry=60,
+                            read_timeout=15, http2=HTTP2_ENABLED),
+    "gas": UpstreamConfig(max_connections=20, max_keepalive=10, keepalive_expiry=60, read_timeout=30,
+                          http2=HTTP2_ENABLED, follow_redirects=True),
+    "gas_upload": UpstreamConfig(max_connections=UPLOAD_GLOBAL_CONCURRENCY, max_keepalive=UPLOAD_GLOBAL_CONCURRENCY,
+                                 keepalive_expiry=60, read_timeout=60, write_timeout=60,
+                                 http2=HTTP2_ENABLED, follow_redirects=True),
+    "amo_report": UpstreamConfig(max_connections=4, max_keepalive=2, read_timeout=15),
+    "telegram": UpstreamConfig(max_connections=4, max_keepalive=2, read_timeout=15, http2=HTTP2_ENABLED),
+    "albato": UpstreamConfig(max_connections=4, max_keepalive=2, read_timeout=5, write_timeout=5),
+}
 
 # Настраиваем апишку
 
-amo_api = AmoAPI(AMO_BASE_URL, AMO_ACCESS_TOKEN)
+# Метрики всего приложения, отдаются на /metrics
+metrics = MetricsRegistry(prefix="volna")
+
+http_transports = HttpTransports(UPSTREAMS, metrics=metrics)
+
+amo_api = AmoAPI(AMO_BASE_URL, AMO_ACCESS_TOKEN, AMO_LEAD_CACHE_TTL, AMO_LEAD_CACHE_SIZE,
+                 AMO_CONTACT_CACHE_TTL, AMO_CONTACT_CACHE_SIZE,
+                 rate_limit=AMO_RATE_LIMIT, rate_burst=AMO_RATE_BURST, max_retries=AMO_MAX_RETRIES,
+                 transports=http_transports)
 
 amo_api.add_basic_field("pipeline_id", int, "ID Воронки")
 amo_api.add_basic_field("status_id", int, "ID статуса")
@@ -69,3 +159,5 @@ amo_api.add_custom_field("is_activated", 679695, bool, "Аккаунт акти
 amo_api.add_custom_field("has_full_support", 680029, bool, "Куплено сопровождение", False)
 
 amo_api.add_custom_field("access_info", 680071, str, "Информация о доступах", "")
+
+amo_api.compile_fields()
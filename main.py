@@ -1,3 +1,5 @@
+import asyncio
+import time
 from contextlib import asynccontextmanager
 
 import uvicorn
@@ -7,50 +9,104 @@ from pydantic import ValidationError
 from starlette.requests import Request
 from starlette.staticfiles import StaticFiles
 
-from src.dependencies import gas_api, templates
-from src.exceptions import InsufficientDataError
+from src.classes.static_assets import PrecompressedStaticFiles
+
+from src.dependencies import gas_api, templates, preview_renderer, job_queue, amo_reporter, tg_logger, asset_manifest, \
+    upload_generations
+from src.utils import precompile_templates
+from src.exceptions import InsufficientDataError, UpstreamUnavailableError
 from src.models.customer import Customer
 from src.models.group import Group
 from src.models.faq import FAQ
 
-from config import logger, amo_api
+from config import logger, amo_api, CATALOG_REFRESH_INTERVAL, JOB_WORKERS, http_transports, metrics, ADMIN_TOKEN, \
+    PROFILE_SAMPLE_INTERVAL, TEMPLATES_AUTO_RELOAD, STATIC_FOLDER, STATIC_BUILD_FOLDER, LOG_FILE
+from src.jobs import register_jobs
+from src.middlewares import MetricsMiddleware, ServerTimingMiddleware
 from src.routes.admin import admin_router
 from src.routes.api import api_router
 from src.routes.documents import document_router
-from src.routes.exceptions import insufficient_data_exception_handler, generic_exception_handler
+from src.routes.exceptions import insufficient_data_exception_handler, generic_exception_handler, \
+    upstream_unavailable_exception_handler
+from src.routes.previews import preview_router
 from src.routes.profile import profile_router
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Manages the application lifespan (startup and shutdown)."""
+    # Файловый лог подключаем здесь, а не при импорте: модули приложения заново импортируют процессы рендера превью
+    logger.add(LOG_FILE, rotation="12:00")
     logger.info("Запуск: Application starting up...")
-    try:
-        await gas_api.preload()
-        logger.info("Запуск: Application started successfully!")
-    except ConnectError as error:
-        logger.error("Запуск: Cant connect to GDrive!")
-        return
+    background_tasks: list[asyncio.Task] = []
+
+    # Один пул соединений на каждый внешний сервис, до первых запросов к ним
+    http_transports.open()
+
+    # Первые запросы после деплоя не должны ждать компиляции шаблонов
+    if not TEMPLATES_AUTO_RELOAD:
+        started_at = time.perf_counter()
+        compiled = precompile_templates(templates.env)
+        logger.info(f"Запуск: Шаблоны готовы: {compiled} за {(time.perf_counter() - started_at) * 1000:.0f} мс")
+
+    if gas_api.load_snapshot():
+        # Каталог поднят с диска за миллисекунды, свежие данные из гугл-таблиц подтягиваем в фоне
+        background_tasks.append(asyncio.create_task(gas_api.refresh()))
+        logger.info("Запуск: Application started from catalog snapshot!")
+    else:
+        try:
+            await gas_api.preload()
+            logger.info("Запуск: Application started successfully!")
+        except ConnectError as error:
+            logger.error("Запуск: Cant connect to GDrive! Каталог подтянет фоновое обновление")
+        except Exception as error:
+            logger.error(f"Запуск: Cant load catalog from GDrive: {error!r}")
+
+    if CATALOG_REFRESH_INTERVAL > 0:
+        background_tasks.append(asyncio.create_task(gas_api.run_refresher(CATALOG_REFRESH_INTERVAL)))
+
+    # Фоновые задачи: прерванные прошлой остановкой возвращаются в очередь до старта воркеров
+    register_jobs(job_queue)
+    await job_queue.recover()
+    for _ in range(JOB_WORKERS):
+        background_tasks.append(asyncio.create_task(job_queue.run_worker()))
+
+    background_tasks.append(asyncio.create_task(amo_reporter.run()))
+    background_tasks.append(asyncio.create_task(tg_logger.run()))
+
     try:
         yield
     finally:
         logger.info("Application shutting down...")
+        await asyncio.gather(amo_reporter.drain(timeout=5), tg_logger.drain(timeout=5))
+        for task in background_tasks:
+            task.cancel()
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+        job_queue.close()
+        upload_generations.close()
+        preview_renderer.shutdown()
+        await http_transports.aclose()
 
 
 app = FastAPI(lifespan=lifespan)
+app.add_middleware(MetricsMiddleware, registry=metrics)
+app.add_middleware(ServerTimingMiddleware, admin_token=ADMIN_TOKEN, profile_interval=PROFILE_SAMPLE_INTERVAL)
 
-routers = (document_router, admin_router, api_router, profile_router)
+routers = (document_router, admin_router, api_router, profile_router, preview_router)
 for router in routers:
     app.include_router(router)
 
 
 app.add_exception_handler(InsufficientDataError, insufficient_data_exception_handler)
+app.add_exception_handler(UpstreamUnavailableError, upstream_unavailable_exception_handler)
 app.add_exception_handler(ValidationError, generic_exception_handler)
 app.add_exception_handler(Exception, generic_exception_handler)
 
 # Делаем доступными папки загрузки и статики
 # Папка с загрузками должна быть смонтирована на диск как хранилище, если используется serverless
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# Собранная статика (python build_assets.py) отдается сжатой и с хешами в именах, иначе – исходная папка
+static_folder = STATIC_BUILD_FOLDER if asset_manifest.is_built else STATIC_FOLDER
+app.mount("/static", PrecompressedStaticFiles(directory=static_folder, manifest=asset_manifest), name="static")
 app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
 
 
@@ -79,8 +135,8 @@ async def events(request: Request, amo_id: int):
 
 @app.get("/faq/{amo_id}")
 async def events(request: Request, amo_id: int):
-    """Вывод странички FAQ"""
-    faq: list[FAQ] = await gas_api.get_all_faqs()
+    """Вывод странички FAQ из снимка каталога, без похода в гугл-таблицы"""
+    faq: tuple[FAQ, ...] = gas_api.faq
 
     context = {
         "request": request,
@@ -1,51 +1,251 @@
+import asyncio
+import random
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from itertools import count
+from typing import Any, Callable, Hashable
+
 import httpx
 from httpx import HTTPError
 from loguru import logger
 
+from src.classes.http_transports import HttpTransports, UpstreamConfig
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+
+# События, для которых важно только последнее состояние сделки: повторные схлопываются в одно
+COALESCED_EVENTS = {"activate", "update_documents"}
+
+
+@dataclass
+class OutgoingEvent:
+    """Событие в очереди на отправку и все, кто ждет его доставки"""
+    payload: dict[str, Any]
+    enqueued_at: float
+    futures: list[asyncio.Future] = field(default_factory=list)
+    attempts: int = 0
+
 
 class AmoReporter:
+    """
+    Отправляет события в АМО через вебхук не в запросе, а из фоновой очереди.
+    Повторные update_documents по одной сделке схлопываются до последнего состояния,
+    несколько событий уходят одним запросом (если batch_size > 1), неудачные отправки повторяются с паузой.
+    Каждый метод сразу возвращает future, который завершится, когда событие доставлено – его можно ждать, а можно нет.
+    """
+
+    # Имя апстрима в HttpTransports
+    UPSTREAM = "amo_report"
 
-    def __init__(self, report_url):
+    def __init__(self, report_url, on_write: Callable[[int], None] | None = None, max_size: int = 1000,
+                 batch_size: int = 1, linger: float = 0.2, max_retries: int = 5, transports: HttpTransports | None = None):
         self._report_url = report_url
-        self.client = httpx.AsyncClient(timeout=15.0)
+        self.transports: HttpTransports = transports or HttpTransports({self.UPSTREAM: UpstreamConfig()})
 
-    async def activate(self, amo_id: int):
-        """Отмечает в АМО, что клиент активировался"""
+        # Вызывается после каждой записи в АМО, чтобы сбросить закешированную сделку
+        self._on_write = on_write
+
+        self.max_size: int = max_size
+        self.batch_size: int = batch_size  # Вебхук tglk принимает по одному событию, поэтому по умолчанию 1
+        self.linger: float = linger  # Сколько ждем перед отправкой, чтобы успели схлопнуться повторы
+        self.max_retries: int = max_retries
 
-        event_type = "activate"
-        payload = {"event_type": event_type, "deal_id": amo_id}
-        result = await self._make_request(payload)
-        logger.debug(result.json())
-        return result.json()
+        self._queue: OrderedDict[Hashable, OutgoingEvent] = OrderedDict()
+        self._sequence = count()
+        self._has_events = asyncio.Event()
+        self._idle = asyncio.Event()
+        self._idle.set()
 
-    async def update_documents(self, amo_id: int, doc_ids: list[int]):
+        # Метрики очереди
+        self.events_total: int = 0
+        self.coalesced_total: int = 0
+        self.delivered_total: int = 0
+        self.failed_total: int = 0
+        self.dropped_total: int = 0
+        self.flushes_total: int = 0
+        self.flush_seconds_total: float = 0.0
+        self.delivery_seconds_total: float = 0.0
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        return self.transports.get(self.UPSTREAM)
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    @property
+    def stats(self) -> dict[str, float]:
+        return {
+            "queue_depth": self.queue_depth,
+            "events_total": self.events_total,
+            "coalesced_total": self.coalesced_total,
+            "delivered_total": self.delivered_total,
+            "failed_total": self.failed_total,
+            "dropped_total": self.dropped_total,
+            "flushes_total": self.flushes_total,
+            "flush_seconds_total": round(self.flush_seconds_total, 3),
+            "delivery_seconds_total": round(self.delivery_seconds_total, 3),
+        }
+
+    # СОБЫТИЯ
+
+    def activate(self, amo_id: int) -> asyncio.Future:
+        """Отмечает в АМО, что клиент активировался"""
+        return self._enqueue({"event_type": "activate", "deal_id": amo_id})
+
+    def update_documents(self, amo_id: int, doc_ids: list[int]) -> asyncio.Future:
         """Отмечает в АМО новый список загруженных документов"""
-        event_type = "update_documents"
-        payload = {"event_type": event_type, "deal_id": amo_id, "documents": doc_ids}
-        result = await self._make_request(payload)
-        return result.json()
+        return self._enqueue({"event_type": "update_documents", "deal_id": amo_id, "documents": doc_ids})
 
-    async def add_comment(self, amo_id: int, message: str):
+    def add_comment(self, amo_id: int, message: str) -> asyncio.Future:
         """Добавляет в АМО новый комментарий"""
-        event_type = "add_comment"
-        payload = {"event_type": event_type, "deal_id": amo_id, "message": message}
-        result = await self._make_request(payload)
-        return result.json()
+        return self._enqueue({"event_type": "add_comment", "deal_id": amo_id, "message": message})
 
-    async def add_task(self, amo_id: int, title: str, description: str):
+    def add_task(self, amo_id: int, title: str, description: str) -> asyncio.Future:
         """Добавляет в АМО новую задачу"""
-        event_type = "add_task"
-        payload = {"event_type": event_type, "deal_id": amo_id, "title": title, "description": description}
-        result = await self._make_request(payload)
-        return result.json()
+        return self._enqueue({"event_type": "add_task", "deal_id": amo_id, "title": title, "description": description})
+
+    # ОЧЕРЕДЬ
+
+    def _enqueue(self, payload: dict[str, Any]) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        # Ошибку доставки забирают те, кто ждет future, остальным не нужно предупреждение о непрочитанной ошибке
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
 
-    async def _make_request(self, payload):
+        event_type = payload["event_type"]
+        if event_type in COALESCED_EVENTS:
+            key = (event_type, payload["deal_id"])
+        else:
+            key = (event_type, next(self._sequence))
+
+        self.events_total += 1
+        queued = self._queue.get(key)
+        if queued is not None:
+            # Место в очереди сохраняем, а данные заменяем на последние
+            queued.payload = payload
+            queued.futures.append(future)
+            self.coalesced_total += 1
+            return future
+
+        if len(self._queue) >= self.max_size:
+            self.dropped_total += 1
+            logger.error(f"АМО: Очередь событий переполнена, {event_type} для {payload['deal_id']} не отправлен")
+            future.set_exception(asyncio.QueueFull())
+            return future
+
+        self._queue[key] = OutgoingEvent(payload=payload, enqueued_at=time.monotonic(), futures=[future])
+        self._idle.clear()
+        self._has_events.set()
+        return future
+
+    def _requeue(self, key: Hashable, event: OutgoingEvent):
+        """Возвращает неотправленное событие в начало очереди, если его еще не заменило более новое"""
+        newer = self._queue.get(key)
+        if newer is not None:
+            newer.futures.extend(event.futures)
+            return
+        self._queue[key] = event
+        self._queue.move_to_end(key, last=False)
+
+    async def drain(self, timeout: float):
+        """Ждет отправки всего, что в очереди, но не дольше timeout – вызывается при остановке приложения"""
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"АМО: При остановке не отправлено событий: {self.queue_depth}")
+
+    async def run(self):
+        """Фоновая отправка очереди, запускается в lifespan"""
+        while True:
+            await self._has_events.wait()
+            await asyncio.sleep(self.linger)
+
+            batch: list[tuple[Hashable, OutgoingEvent]] = []
+            while self._queue and len(batch) < self.batch_size:
+                batch.append(self._queue.popitem(last=False))
+            if not self._queue:
+                self._has_events.clear()
+            if not batch:
+                self._idle.set()
+                continue
+
+            try:
+                retry_after = await self._flush(batch)
+            except Exception as error:
+                # Неожиданная ошибка не должна останавливать отправку: проваливаем только эту пачку
+                logger.error(f"АМО: Ошибка при отправке пачки событий: {error!r}")
+                self._fail_batch(batch, repr(error))
+                retry_after = 0
+
+            if not self._queue:
+                self._idle.set()
+            if retry_after:
+                await asyncio.sleep(retry_after)
+
+    def _fail_batch(self, batch: list[tuple[Hashable, OutgoingEvent]], reason: str):
+        """Завершает ошибкой всех, кто еще ждет событий пачки"""
+        for _, event in batch:
+            pending = [future for future in event.futures if not future.done()]
+            if pending:
+                self.failed_total += 1
+            for future in pending:
+                future.set_exception(RuntimeError(f"АМО не принял событие: {reason}"))
+
+    async def _flush(self, batch: list[tuple[Hashable, OutgoingEvent]]) -> float:
+        """Отправляет пачку событий. Возвращает паузу перед следующей отправкой, если вебхук не принял пачку"""
+
+        payloads = [event.payload for _, event in batch]
+        logger.info(f"АМО: Отправляем {', '.join(f'{p['event_type']} для {p['deal_id']}' for p in payloads)}")
+
+        started_at = time.monotonic()
         try:
-            logger.info(f"Отправляем запрос {payload["event_type"]} в AMO для пользователя {payload["amo_id"]}")
-            response = await self.client.post(self._report_url, json=payload)
-            return response
+            body = payloads[0] if self.batch_size == 1 else payloads
+            response = await self.client.post(self._report_url, json=body)
+            error = f"HTTP {response.status_code}" if response.status_code >= 400 else None
+            is_retryable = response.status_code in RETRY_STATUSES
+            retry_after = response.headers.get("Retry-After")
+        except HTTPError as exception:
+            error, is_retryable, retry_after = repr(exception), True, None
+        finally:
+            self.flushes_total += 1
+            self.flush_seconds_total += time.monotonic() - started_at
 
-        except HTTPError as error:
-            logger.error(f"Не удалось отправить {payload["event_type"]} в AMO для пользователя {payload["amo_id"]}")
-            return {}
+        if error is None:
+            for _, event in batch:
+                self.delivered_total += 1
+                self.delivery_seconds_total += time.monotonic() - event.enqueued_at
+                for future in event.futures:
+                    if not future.done():
+                        future.set_result(True)
+                if self._on_write is not None:
+                    self._on_write(event.payload["deal_id"])
+            return 0
 
+        attempts = max(event.attempts for _, event in batch) + 1
+        for key, event in reversed(batch):
+            event.attempts += 1
+            if is_retryable and event.attempts <= self.max_retries:
+                self._requeue(key, event)
+                continue
+
+            self.failed_total += 1
+            logger.error(f"АМО: Не удалось отправить {event.payload['event_type']} "
+                         f"для {event.payload['deal_id']}: {error}")
+            for future in event.futures:
+                if not future.done():
+                    future.set_exception(RuntimeError(f"АМО не принял событие: {error}"))
+
+        if not self._queue:
+            return 0
+
+        self._has_events.set()
+        try:
+            delay = min(RETRY_MAX_DELAY, max(0.0, float(retry_after)))
+        except (TypeError, ValueError):
+            delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempts))
+        logger.warning(f"АМО: Вебхук ответил {error}, повтор через {delay:.1f} с")
+        return delay
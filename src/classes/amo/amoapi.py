@@ -1,18 +1,35 @@
+import asyncio
 import json
+import random
 import zoneinfo
 from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from itertools import batched
 from pprint import pprint
 import re
+from functools import partial
+from typing import Callable, Iterable, NamedTuple
 
 import httpx
 from loguru import logger
 from typing_extensions import deprecated
 
 from src.classes.amo.types import AmoCustomField, AmoBasicField, ContactDict, CustomFieldDict, ExtraDoc
-from src.exceptions import InsufficientDataError
+from src.classes.http_transports import HttpTransports, UpstreamConfig
+from src.classes.ttl_cache import TTLCache
+from src.classes.amo.rate_limiter import KommoRateLimiter, Priority
+from src.exceptions import InsufficientDataError, UpstreamUnavailableError
 from src.models.customer import Customer
 from src.models.document import ExtraDocument, Document
 
+TIMEZONE = zoneinfo.ZoneInfo("Asia/Qatar")
+DOCDICT_LINE_PATTERN = re.compile(r"^\s*\[([^\]]+)\]\s*(.*?)\s*$")
+
+# На эти ответы Kommo запрос стоит повторить: лимит запросов или временная ошибка сервера
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+RETRY_BASE_DELAY = 0.5
+RETRY_MAX_DELAY = 10.0
+
 
 class FieldConverter:
     """Набор функций преобразования значений для вытаскивания из полей Амо данных в любом заданном виде"""
@@ -24,7 +41,7 @@ class FieldConverter:
         :return:
         """
         doc_dict: dict[str, ExtraDocument] = {}
-        pattern = re.compile(r"^\s*\[([^\]]+)\]\s*(.*?)\s*$")
+        pattern = DOCDICT_LINE_PATTERN
 
         for line in lines.strip().split('\n'):
             line = line.strip()  # Clean up individual line whitespace
@@ -44,9 +61,7 @@ class FieldConverter:
 
     @staticmethod
     def timestamp_to_datetime(field: AmoCustomField | AmoBasicField, timestamp: int | str) -> datetime:
-        logger.debug(timestamp)
-        asian_plus_3_tz = zoneinfo.ZoneInfo("Asia/Qatar")
-        return datetime.fromtimestamp(int(timestamp), tz=asian_plus_3_tz)
+        return datetime.fromtimestamp(int(timestamp), tz=TIMEZONE)
 
     @staticmethod
     def list_to_int_list(field: AmoCustomField | AmoBasicField, elements: list, default=None):
@@ -82,16 +97,86 @@ class FieldConverter:
         return result
 
 
+class ValueExtractor:
+    """Способы достать значение из произвольного поля Амо, в зависимости от заданного для поля типа"""
+
+    @staticmethod
+    def first_value(field_data: CustomFieldDict) -> any:
+        return field_data["values"][0]['value']
+
+    @staticmethod
+    def all_values(field_data: CustomFieldDict) -> list:
+        return [element["value"] for element in field_data["values"]]
+
+    @staticmethod
+    def as_is(field_data: CustomFieldDict) -> CustomFieldDict:
+        return field_data
+
+    by_type: dict[type, Callable[[CustomFieldDict], any]] = {
+        str: first_value,
+        list: all_values,
+        bool: first_value,
+        datetime: first_value,
+    }
+
+
+class FieldPlanItem(NamedTuple):
+    """Скомпилированный шаг извлечения одного произвольного поля"""
+    key: str
+    field_id: int
+    default: any
+    extract: Callable[[CustomFieldDict], any]
+    convert: Callable[[any], any] | None
+
+
+class PartialLeadError(Exception):
+    """Сделка загружена, а имя контакта – нет, потому что Kommo не ответил. Такого клиента показываем, но не кешируем"""
+
+    def __init__(self, customer: Customer):
+        super().__init__(customer.amo_id)
+        self.customer: Customer = customer
+
+
 class AmoAPI:
 
-    def __init__(self, base_url: str, access_token: str):
+    # Kommo отдает списки страницами не больше 250 элементов
+    PAGE_LIMIT = 250
+    # Сколько ID передаем в одном filter[id][], чтобы не упереться в длину URL
+    FILTER_CHUNK_SIZE = 50
+    # Имя апстрима в HttpTransports
+    UPSTREAM = "kommo"
+
+    def __init__(self, base_url: str, access_token: str, lead_cache_ttl: float = 60, lead_cache_size: int = 1000,
+                 contact_cache_ttl: float = 24 * 60 * 60, contact_cache_size: int = 5000, prefetch_contacts: bool = True,
+                 rate_limit: float = 7.0, rate_burst: int = 7, max_retries: int = 3,
+                 transports: HttpTransports | None = None):
 
         self.base_url: str = base_url
         self.access_token: str = access_token
         self.basic_fields: dict[str, AmoBasicField] = {}
         self.custom_fields: dict[str, AmoCustomField] = {}
+        self._field_plan: tuple[FieldPlanItem, ...] | None = None
+
+        # Соединения общие на приложение, без реестра (например, в скриптах) заводим свой
+        self.transports: HttpTransports = transports or HttpTransports({self.UPSTREAM: UpstreamConfig()})
+
+        # Все запросы к Kommo проходят через общий лимитер, 429 и 5xx повторяются с бэкоффом
+        self.limiter: KommoRateLimiter = KommoRateLimiter(rate=rate_limit, burst=rate_burst)
+        self.max_retries: int = max_retries
+
+        # Кеш сделок: повторные заходы студента не ходят в Kommo, пока запись жива
+        self.lead_cache: TTLCache = TTLCache(ttl=lead_cache_ttl, maxsize=lead_cache_size, name="amo_leads")
+
+        # Имена контактов почти не меняются, поэтому живут в кеше долго
+        self.contact_cache: TTLCache = TTLCache(ttl=contact_cache_ttl, maxsize=contact_cache_size, name="amo_contacts")
 
-        self.client = httpx.AsyncClient(timeout=15.0)
+        # Запоминаем основной контакт сделки, чтобы в следующий раз запросить имя параллельно со сделкой
+        self.prefetch_contacts: bool = prefetch_contacts
+        self.lead_contacts: TTLCache = TTLCache(ttl=contact_cache_ttl, maxsize=contact_cache_size, name="amo_lead_contacts")
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        return self.transports.get(self.UPSTREAM)
 
     # Интерфейс регистрации полей
 
@@ -101,6 +186,21 @@ class AmoAPI:
     def add_custom_field(self, field_key, field_id, field_type, field_label, default=None, convert: callable = None):
         """Add field to extract after fetching"""
         self.custom_fields[field_key] = AmoCustomField(field_key, field_id, field_type, field_label, default, convert)
+        self._field_plan = None
+
+    def compile_fields(self) -> tuple[FieldPlanItem, ...]:
+        """
+        Собирает план извлечения произвольных полей: экстрактор по типу и конвертер выбираются один раз,
+        а не на каждой сделке. Вызывается после регистрации полей, либо лениво при первом разборе сделки.
+        """
+        plan: list[FieldPlanItem] = []
+        for field in self.custom_fields.values():
+            extract = ValueExtractor.by_type.get(field.type, ValueExtractor.as_is)
+            convert = partial(field.convert, field) if field.convert is not None else None
+            plan.append(FieldPlanItem(field.key, field.id, field.default, extract, convert))
+
+        self._field_plan = tuple(plan)
+        return self._field_plan
 
     # Интерфейс сохранения полей
 
@@ -116,40 +216,236 @@ class AmoAPI:
             'Content-Type': 'application/json'
         }
 
+    # Запросы к Kommo
+
+    async def _request(self, method: str, url: str, priority: Priority = Priority.INTERACTIVE,
+                       **kwargs) -> httpx.Response:
+        """
+        Выполняет запрос к Kommo через общий лимитер.
+        На 429, 5xx и сетевые ошибки повторяет запрос с экспоненциальной задержкой и джиттером,
+        уважая Retry-After. Если Kommo так и не ответил, выбрасывает UpstreamUnavailableError.
+        """
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.limiter.slot(priority):
+                    response = await self.client.request(method, url, headers=self.headers, **kwargs)
+            except httpx.TransportError as error:
+                reason, retry_after = repr(error), None
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    return response
+                reason, retry_after = f"HTTP {response.status_code}", self._parse_retry_after(response)
+                if response.status_code == 429 and retry_after is not None:
+                    self.limiter.pause(retry_after)
+
+            if attempt == self.max_retries:
+                logger.error(f"Kommo недоступен: {method} {url} ({reason})")
+                raise UpstreamUnavailableError()
+
+            delay = retry_after if retry_after is not None else self._backoff(attempt)
+            logger.warning(f"Kommo ответил {reason}, повтор {attempt + 1}/{self.max_retries} через {delay:.2f} с")
+            await asyncio.sleep(delay)
+
+    @staticmethod
+    def _backoff(attempt: int) -> float:
+        """Экспоненциальная задержка с полным джиттером"""
+        return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+    @staticmethod
+    def _parse_retry_after(response: httpx.Response) -> float | None:
+        """Retry-After бывает числом секунд или HTTP-датой"""
+        value = response.headers.get("Retry-After")
+        if value is None:
+            return None
+        try:
+            return min(RETRY_MAX_DELAY, max(0.0, float(value)))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return min(RETRY_MAX_DELAY, max(0.0, (retry_at - datetime.now(timezone.utc)).total_seconds()))
+
     # Загружаем данные
-    async def fetch_lead_data(self, lead_id: int) -> Customer | None:
+    async def fetch_lead_data(self, lead_id: int, priority: Priority = Priority.INTERACTIVE) -> Customer | None:
+        """Возвращает клиента по ID сделки. Повторные и одновременные запросы обслуживаются из кеша"""
 
-        url = f"{self.base_url}/api/v4/leads/{lead_id}?with=contacts,status"
-        response = await self.client.get(url, headers=self.headers)
+        try:
+            customer: Customer = await self.lead_cache.get_or_fetch(lead_id, lambda: self._load_lead(lead_id, priority))
+        except PartialLeadError as error:
+            # Иначе после сбоя Kommo студент до конца TTL видел бы приветствие без имени
+            customer = error.customer
 
-        if response.status_code != 200:
-            print(response)
-            raise InsufficientDataError("Клиент не найден в базе")
+        # Роуты дописывают в клиента документы и загрузки, поэтому закешированный объект наружу не отдаем
+        return customer.model_copy(deep=True)
+
+    def invalidate(self, lead_id: int):
+        """Сбрасывает закешированную сделку, например после записи в АМО"""
+        self.lead_cache.invalidate(lead_id)
+
+    async def _load_lead(self, lead_id: int, priority: Priority) -> Customer:
 
-        lead_raw = response.json()
+        known_contact_id: int | None = self.lead_contacts.get(lead_id) if self.prefetch_contacts else None
+
+        if known_contact_id is not None:
+            # Контакт уже известен: имя берем из кеша или запрашиваем одновременно со сделкой
+            lead_raw, name_fields = await asyncio.gather(self._get_lead_raw(lead_id, priority),
+                                                         self._get_contact_names(known_contact_id, priority))
+            if self._get_contact_id(lead_raw) != known_contact_id:
+                name_fields = await self._get_lead_names(lead_raw, priority)
+        else:
+            lead_raw = await self._get_lead_raw(lead_id, priority)
+            name_fields = await self._get_lead_names(lead_raw, priority)
+
+        if name_fields is None:
+            logger.warning(f"Сделка {lead_id} загружена без имени контакта, в кеш не кладем")
+            raise PartialLeadError(self._build_customer(lead_raw, {"first_name": "", "last_name": "", "full_name": ""}))
+
+        return self._build_customer(lead_raw, name_fields)
+
+    def _build_customer(self, lead_raw: dict, name_fields: dict[str, str]) -> Customer:
 
         basic_fields: dict[str: any] = self._extract_all_basic_fields(lead_raw)
         custom_fields: dict[str: any] = self._extract_all_custom_fields(lead_raw)
-        name_fields: dict[str: str] = await self._get_lead_names(lead_raw)
 
-        customer_data: dict[str: any] = basic_fields | custom_fields | name_fields | {"amo_id": lead_id}
+        customer_data: dict[str: any] = basic_fields | custom_fields | name_fields | {"amo_id": lead_raw["id"]}
         customer: Customer = Customer(**customer_data)
 
         return customer
 
-    async def _get_lead_names(self, lead_raw) -> dict[str, str]:
+    async def fetch_leads_bulk(self, lead_ids: Iterable[int], priority: Priority = Priority.BACKGROUND) -> list[Customer]:
+        """Загружает пачку сделок списочными запросами Kommo и прогревает кеши сделок и контактов"""
+
+        leads_raw: list[dict] = []
+        for chunk in batched(dict.fromkeys(lead_ids), self.FILTER_CHUNK_SIZE):
+            params = [("filter[id][]", lead_id) for lead_id in chunk]
+            leads_raw += await self._list_entities("leads", params + [("with", "contacts")], priority)
 
+        return await self._build_customers(leads_raw, priority)
+
+    async def fetch_pipeline_leads(self, pipeline_id: int, priority: Priority = Priority.BACKGROUND) -> list[Customer]:
+        """Загружает все сделки воронки, например OPERATIONAL_FUNNEL_ID, и прогревает кеши"""
+
+        params = [("filter[pipeline_id][]", pipeline_id), ("with", "contacts")]
+        leads_raw: list[dict] = await self._list_entities("leads", params, priority)
+
+        return await self._build_customers(leads_raw, priority)
+
+    async def _build_customers(self, leads_raw: list[dict], priority: Priority) -> list[Customer]:
+        """Собирает клиентов из списка сделок, имена дозапрашивает одной пачкой"""
+
+        contact_ids: dict[int, int] = {}
+        for lead_raw in leads_raw:
+            contact_id = self._get_contact_id(lead_raw)
+            if contact_id is not None:
+                contact_ids[lead_raw["id"]] = contact_id
+                self.lead_contacts.set(lead_raw["id"], contact_id)
+
+        await self._fetch_contacts_bulk(contact_ids.values(), priority)
+
+        customers: list[Customer] = []
+        for lead_raw in leads_raw:
+            contact_id = contact_ids.get(lead_raw["id"])
+            name_fields = self.contact_cache.get(contact_id) if contact_id is not None else None
+            if name_fields is None:
+                name_fields = {"first_name": "", "last_name": "", "full_name": ""}
+
+            customer: Customer = self._build_customer(lead_raw, name_fields)
+            self.lead_cache.set(customer.amo_id, customer)
+            customers.append(customer.model_copy(deep=True))
+
+        return customers
+
+    async def _fetch_contacts_bulk(self, contact_ids: Iterable[int], priority: Priority):
+        """Догружает в кеш имена контактов, которых там еще нет"""
+
+        missing: list[int] = [contact_id for contact_id in dict.fromkeys(contact_ids) if contact_id not in self.contact_cache]
+
+        for chunk in batched(missing, self.FILTER_CHUNK_SIZE):
+            params = [("filter[id][]", contact_id) for contact_id in chunk]
+            contacts_raw: list[ContactDict] = await self._list_entities("contacts", params, priority)
+
+            for contact_raw in contacts_raw:
+                self.contact_cache.set(contact_raw["id"], {"first_name": contact_raw["first_name"],
+                                                           "last_name": contact_raw["last_name"],
+                                                           "full_name": contact_raw["name"]})
+
+    async def _list_entities(self, entity: str, params: list[tuple[str, any]], priority: Priority) -> list[dict]:
+        """Обходит все страницы списочного эндпоинта Kommo (leads, contacts)"""
+
+        url = f"{self.base_url}/api/v4/{entity}"
+        result: list[dict] = []
+        page = 1
+
+        while True:
+            page_params = params + [("limit", self.PAGE_LIMIT), ("page", page)]
+            response = await self._request("GET", url, priority, params=page_params)
+
+            # На пустую выборку Kommo отвечает 204 без тела
+            if response.status_code == 204:
+                break
+            if response.status_code != 200:
+                logger.error(f"Не удалось получить список {entity}: {response.status_code}")
+                raise InsufficientDataError(f"Не удалось получить список {entity}")
+
+            data = response.json()
+            result += data.get("_embedded", {}).get(entity, [])
+
+            if "next" not in data.get("_links", {}):
+                break
+            page += 1
+
+        return result
+
+    async def _get_lead_raw(self, lead_id: int, priority: Priority) -> dict:
+
+        url = f"{self.base_url}/api/v4/leads/{lead_id}?with=contacts,status"
+        response = await self._request("GET", url, priority)
+
+        if response.status_code != 200:
+            logger.warning(f"Kommo вернул {response.status_code} для сделки {lead_id}")
+            raise InsufficientDataError("Клиент не найден в базе")
+
+        return response.json()
+
+    @staticmethod
+    def _get_contact_id(lead_raw) -> int | None:
         try:
-            contact_id = lead_raw["_embedded"]["contacts"][0]["id"]
-        except (IndexError, KeyError):
+            return lead_raw["_embedded"]["contacts"][0]["id"]
+        except (IndexError, KeyError, TypeError):
+            return None
+
+    async def _get_lead_names(self, lead_raw, priority: Priority) -> dict[str, str] | None:
+
+        contact_id = self._get_contact_id(lead_raw)
+        if contact_id is None:
             logger.error("Не получилось получить имя")
             return {"first_name": "", "last_name": "", "full_name": ""}
 
-        url = f"{self.base_url}/api/v4/contacts/{contact_id}?with=contacts,status"
-        response = await self.client.get(url, headers=self.headers)
-        if response.status_code != 200:
-            logger.debug(f"Не удалось получить имя клиента {lead_raw["id"]} ")
+        self.lead_contacts.set(lead_raw["id"], contact_id)
+        return await self._get_contact_names(contact_id, priority)
+
+    async def _get_contact_names(self, contact_id: int, priority: Priority) -> dict[str, str] | None:
+        """Возвращает имя контакта из кеша, при промахе запрашивает его в Kommo. None – если Kommo не ответил"""
+
+        try:
+            return await self.contact_cache.get_or_fetch(contact_id,
+                                                         lambda: self._fetch_contact_names(contact_id, priority))
+        except InsufficientDataError:
+            logger.debug(f"Контакт {contact_id} не найден")
             return {"first_name": "", "last_name": "", "full_name": ""}
+        except UpstreamUnavailableError:
+            logger.debug(f"Не удалось получить имя контакта {contact_id}")
+            return None
+
+    async def _fetch_contact_names(self, contact_id: int, priority: Priority) -> dict[str, str]:
+
+        url = f"{self.base_url}/api/v4/contacts/{contact_id}"
+        response = await self._request("GET", url, priority)
+        if response.status_code != 200:
+            raise InsufficientDataError("Контакт не найден в базе")
 
         contact_raw: ContactDict = response.json()
 
@@ -180,49 +476,24 @@ class AmoAPI:
 
         return result
 
-    def _extract_custom_field_data(self, field: AmoCustomField, field_data: CustomFieldDict) -> any:
-        """Извлекает данные одного произвольного поля в зависимости от заданного для field типа"""
-
-        # Если данных тупо нет – возвращаем дефолтное значение
-        if field_data is None:
-            return field.default
-
-        elif field.type == str:
-            result = field_data["values"][0]['value']
-
-        elif field.type == list:
-            result = [element["value"] for element in field_data["values"]]
-
-        elif field.type == bool:
-            result = field_data["values"][0]['value']
-
-        elif field.type == datetime:
-            result = field_data["values"][0]['value']
-
-        else:
-            result = field_data
+    def _extract_all_custom_fields(self, lead_raw) -> dict[str, AmoCustomField]:
+        """Извлекает все зарегистрированные произвольные поля за один проход по значениям сделки"""
 
-        # Если задано правило конвертации
-        if field.convert is not None:
-            converted_result = field.convert(field, result)
-            return converted_result
+        plan = self._field_plan if self._field_plan is not None else self.compile_fields()
 
-        return result
+        custom_data: list[CustomFieldDict] = lead_raw.get("custom_fields_values") or []
+        values_by_id: dict[int, CustomFieldDict] = {field_data["field_id"]: field_data for field_data in custom_data}
 
-    def _extract_all_custom_fields(self, lead_raw) -> dict[str, AmoCustomField]:
         result = {}
+        for item in plan:
+            field_data: CustomFieldDict | None = values_by_id.get(item.field_id)
 
-        if "custom_fields_values" in lead_raw and lead_raw["custom_fields_values"] is not None:
-            custom_data: list[dict] = lead_raw["custom_fields_values"]
-        else:
-            custom_data: list = []
-
-        for field in self.custom_fields.values():
-            field_key = field.key
-            field_id = field.id
-
-            field_data: CustomFieldDict | None = next((f for f in custom_data if f["field_id"] == field_id), None)
+            # Если данных тупо нет – возвращаем дефолтное значение
+            if field_data is None:
+                result[item.key] = item.default
+                continue
 
-            result[field_key] = self._extract_custom_field_data(field, field_data)
+            value = item.extract(field_data)
+            result[item.key] = item.convert(value) if item.convert is not None else value
 
         return result
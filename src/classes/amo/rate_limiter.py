@@ -0,0 +1,122 @@
+import asyncio
+import heapq
+import time
+from contextlib import asynccontextmanager
+from enum import IntEnum
+from itertools import count
+
+
+class Priority(IntEnum):
+    """Приоритет запроса к Kommo: чем меньше значение, тем раньше запрос получит токен"""
+    INTERACTIVE = 0  # Студент ждет загрузки страницы
+    BACKGROUND = 1  # Прогрев кешей, отчеты и прочие фоновые задачи
+
+
+class KommoRateLimiter:
+    """
+    Token bucket, общий для всех запросов к Kommo (лимит аккаунта около 7 запросов в секунду).
+    Ожидающие запросы обслуживаются по приоритету, внутри приоритета – по очереди.
+    """
+
+    def __init__(self, rate: float = 7.0, burst: int = 7):
+        self.rate: float = rate
+        self.capacity: float = burst
+
+        self._tokens: float = burst
+        self._updated_at: float = time.monotonic()
+        self._paused_until: float = 0.0
+
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._sequence = count()
+        self._wakeup: asyncio.TimerHandle | None = None
+
+        # Метрики: сколько запросы простояли в очереди и сколько летели до Kommo
+        self.requests_total: int = 0
+        self.queued_seconds_total: float = 0.0
+        self.in_flight_seconds_total: float = 0.0
+        self.in_flight: int = 0
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(1 for *_, future in self._waiters if not future.done())
+
+    @property
+    def stats(self) -> dict[str, float]:
+        return {
+            "requests_total": self.requests_total,
+            "queued_seconds_total": round(self.queued_seconds_total, 3),
+            "in_flight_seconds_total": round(self.in_flight_seconds_total, 3),
+            "queue_depth": self.queue_depth,
+            "in_flight": self.in_flight,
+        }
+
+    def pause(self, seconds: float):
+        """Притормаживает все запросы, например когда Kommo ответил 429 с Retry-After"""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self, priority: Priority = Priority.INTERACTIVE):
+        """Ждет свободный токен с учетом приоритета"""
+
+        if not self._waiters and self._take_token():
+            return
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), future))
+        self._dispatch()
+        await future
+
+    @asynccontextmanager
+    async def slot(self, priority: Priority = Priority.INTERACTIVE):
+        """Занимает токен на время запроса и учитывает время ожидания и время запроса"""
+
+        queued_at = time.monotonic()
+        await self.acquire(priority)
+        started_at = time.monotonic()
+
+        self.queued_seconds_total += started_at - queued_at
+        self.in_flight += 1
+        try:
+            yield
+        finally:
+            self.in_flight -= 1
+            self.requests_total += 1
+            self.in_flight_seconds_total += time.monotonic() - started_at
+
+    def _refill(self):
+        now = time.monotonic()
+        if now < self._paused_until:
+            self._updated_at = now
+            return
+        elapsed = now - max(self._updated_at, self._paused_until)
+        self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+        self._updated_at = now
+
+    def _take_token(self) -> bool:
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+    def _dispatch(self):
+        """Раздает накопившиеся токены ожидающим и планирует следующую раздачу"""
+
+        while self._waiters:
+            *_, future = self._waiters[0]
+            if future.done():  # Ожидающего отменили
+                heapq.heappop(self._waiters)
+                continue
+            if not self._take_token():
+                break
+            heapq.heappop(self._waiters)
+            future.set_result(None)
+
+        if self._waiters and self._wakeup is None:
+            now = time.monotonic()
+            delay = max(self._paused_until - now, (1 - self._tokens) / self.rate, 0.001)
+            self._wakeup = asyncio.get_running_loop().call_later(delay, self._on_wakeup)
+
+    def _on_wakeup(self):
+        self._wakeup = None
+        self._dispatch()
@@ -42,6 +42,7 @@ class CustomFieldDict(TypedDict):
 
 class ContactDict(TypedDict):
     """Информация о контакте,  отдается из AMO"""
+    id: int
     name: str
     first_name: str
     last_name: str
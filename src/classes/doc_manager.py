@@ -1,6 +1,10 @@
+import asyncio
 import base64
+import hashlib
 import os
-from typing import Coroutine, Dict
+import tempfile
+from typing import AsyncIterator, Awaitable, Callable, Coroutine, Dict
+from urllib.parse import quote, quote_from_bytes
 
 import aiofiles
 import httpx
@@ -8,9 +12,11 @@ from fastapi import HTTPException, UploadFile
 from httpx import Response
 from typing_extensions import TypedDict
 
-from config import ALLOWED_EXTENSIONS, UPLOAD_URL, UPLOAD_FOLDER, logger
-from src.models.document import Document, UploadedDocument
-import fitz
+from config import ALLOWED_EXTENSIONS, UPLOAD_URL, UPLOAD_CHUNK_SIZE, MAX_UPLOAD_SIZE, logger, \
+    UPLOAD_GLOBAL_CONCURRENCY, UPLOAD_REQUEST_CONCURRENCY
+from src.classes.http_transports import HttpTransports, UpstreamConfig
+from src.classes.preview_store import PreviewStore
+from src.models.document import Document, UploadedDocument, UploadResult
 
 class GasUploadedDocDict(TypedDict):
     id: int
@@ -26,23 +32,44 @@ class GasUploadedDocDict(TypedDict):
 
 class DocManager:
 
-    def __init__(self):
-        self.client = httpx.AsyncClient(timeout=30.0, follow_redirects=True)
+    # Имя апстрима в HttpTransports: загрузки идут отдельным пулом, чтобы не занимать соединения чтения каталога
+    UPSTREAM = "gas_upload"
 
-    async def _send_to_gdrive(self, data) -> GasUploadedDocDict:
+    def __init__(self, on_upload: Callable[[UploadedDocument], Awaitable[None]] | None = None,
+                 global_concurrency: int = UPLOAD_GLOBAL_CONCURRENCY, request_concurrency: int = UPLOAD_REQUEST_CONCURRENCY,
+                 previews: PreviewStore | None = None, transports: HttpTransports | None = None):
+        self.transports: HttpTransports = transports or HttpTransports(
+            {self.UPSTREAM: UpstreamConfig(read_timeout=30.0, follow_redirects=True)})
+
+        # Хранилище превью забирает PDF после загрузки, сами превью делаются при первом запросе
+        self.previews: PreviewStore | None = previews
+
+        # Сколько файлов одновременно грузим на GAS со всего приложения и из одного запроса
+        self._global_slots = asyncio.Semaphore(global_concurrency)
+        self.request_concurrency: int = request_concurrency
+
+        # Вызывается с каждым загруженным документом, чтобы сразу дописать его в индекс загрузок
+        self._on_upload = on_upload
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        return self.transports.get(self.UPSTREAM)
+
+    async def _send_to_gdrive(self, pdf_path: str, amo_id: int, doc_id: int | str) -> GasUploadedDocDict:
         """
-        Отправляет данные (включая файл) на сервер Google Apps Script (GAS) для сохранения в Google Drive.
-        :param data:  Словарь (dict) с данными, которые необходимо отправить на сервер GAS.
-            - 'file': Закодированная в Base64 строка, представляющая содержимое файла (UploadFile).
-            - 'amo_id': ID пользователя AmoCRM (int).
-            - 'doc_id': ID документа (int).
+        Отправляет файл на сервер Google Apps Script (GAS) для сохранения в Google Drive.
+        Тело формы (amo_id, doc_id и файл в Base64) не собирается в памяти целиком, а кодируется и уходит кусками.
+        :param pdf_path: Путь к временной копии загруженного файла.
+        :param amo_id: ID пользователя AmoCRM (int).
+        :param doc_id: ID документа (int) или название дополнительного документа (str).
         :return:
         """
 
-        amo_id = data.get("amo_id")
         logger.info("Загрузка: Отправляем файл пользователя {amo_id} на GAS сервер", amo_id=amo_id)
 
-        response: Response = await (self.client.post(UPLOAD_URL, data=data))
+        headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        body = self._iter_form_body(pdf_path, amo_id, doc_id)
+        response: Response = await (self.client.post(UPLOAD_URL, content=body, headers=headers))
         response_data: GasUploadedDocDict = response.json()
 
         if "error" in response_data:
@@ -53,49 +80,98 @@ class DocManager:
         return response_data
 
     @staticmethod
-    async def _save_pdf_picture(file_contents: bytes, file_name: str) -> str:
-        """Сохраняет PDF (конвертируя его в PNG) в UPLOAD_FOLDER."""
-        #TODO add exception handler
-
-        logger.info("Загрузка: Создаем превью пдф файла {file_name} локально", file_name=file_name)
-        pdf_document = fitz.open(stream=file_contents, filetype="pdf")
-        page = pdf_document[0]
-        pix = page.get_pixmap()
-        img_byte_arr: bytes = pix.tobytes("png")
+    async def _iter_form_body(pdf_path: str, amo_id: int, doc_id: int | str) -> AsyncIterator[bytes]:
+        """Отдает urlencoded-форму кусками: Base64 кодируется по UPLOAD_CHUNK_SIZE байт, кратно трем"""
 
-        image_path: str = os.path.join(UPLOAD_FOLDER, file_name)
+        yield f"amo_id={quote(str(amo_id))}&doc_id={quote(str(doc_id))}&file=".encode()
 
-        async with aiofiles.open(image_path, "wb") as f:
-            await f.write(img_byte_arr)
+        async with aiofiles.open(pdf_path, "rb") as f:
+            while chunk := await f.read(UPLOAD_CHUNK_SIZE):
+                yield quote_from_bytes(base64.b64encode(chunk), safe="").encode()
 
-        pdf_document.close()
-        logger.info(f"Загрузка: Превью {file_name}  PDF сохранено: {image_path}", file_name=file_name)
-
-        return image_path
+    async def _spool_to_disk(self, file: UploadFile) -> tuple[str, int, str]:
+        """
+        Копирует загруженный файл во временный файл кусками, не превышая MAX_UPLOAD_SIZE, и считает его sha256.
+        :return: Путь к временному файлу, размер файла в байтах и хеш содержимого
+        """
+        size = 0
+        digest = hashlib.sha256()
+
+        # Пишем рядом с хранилищем превью, чтобы потом забрать файл туда переименованием, а не копированием
+        folder = self.previews.sources_folder if self.previews else None
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        fd, pdf_path = tempfile.mkstemp(suffix=".pdf.part", dir=folder)
+        os.close(fd)
+
+        try:
+            async with aiofiles.open(pdf_path, "wb") as f:
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > MAX_UPLOAD_SIZE:
+                        logger.warning(f"Загрузка: Файл {file.filename} больше {MAX_UPLOAD_SIZE // 1024 // 1024} мб")
+                        raise HTTPException(status_code=413, detail=f"File {file.filename} is too large: "
+                                                                    f"max {MAX_UPLOAD_SIZE // 1024 // 1024} MB")
+                    digest.update(chunk)
+                    await f.write(chunk)
+        except BaseException:
+            os.remove(pdf_path)
+            raise
+
+        return pdf_path, size, digest.hexdigest()
 
     async def upload_file(self, file: UploadFile, amo_id: int, doc_id: int) -> UploadedDocument:
-        """Загружает файл на сервер Google Drive, предварительно проверив тип файла и создав превью."""
+        """
+        Загружает файл на сервер Google Drive, предварительно проверив тип и размер файла.
+        Сам файл остается в хранилище превью под своим хешем, рендер превью откладывается до первого показа.
+        """
         filename: str = file.filename
 
         if not filename.lower().split(".")[-1] in ALLOWED_EXTENSIONS:
             logger.warning(f"Тип файла {filename} не поддерживается. Разрешены только PDF.")
             raise HTTPException(status_code=400, detail=f"Invalid file type {filename}: Only PDF files are allowed")
 
-        # TODO Выбросить исключения при большом размере файла
-
-        contents: bytes = await file.read()
-        file: str = base64.b64encode(contents).decode('utf-8')
-        logger.debug("Загрузка: Размер файла {name} = {size}", name=filename, size= f"{len(contents) // 1024} кб")
+        # Держим файл на диске, а не в памяти: в памяти в каждый момент не больше одного куска
+        pdf_path, size, content_hash = await self._spool_to_disk(file)
+        logger.debug("Загрузка: Размер файла {name} = {size}", name=filename, size= f"{size // 1024} кб")
 
-        data = {"amo_id": amo_id, "doc_id": doc_id, "file": file}
+        try:
+            async with self._global_slots:
+                response_data: dict = await self._send_to_gdrive(pdf_path, amo_id, doc_id)
+            uploaded_document = UploadedDocument(**response_data)
+        except BaseException:
+            os.remove(pdf_path)
+            raise
 
-        # TODO Проверить размер файла
-        # TODO Перехватить исключения при загрузке файла
+        if self.previews is None:
+            os.remove(pdf_path)
+        else:
+            self.previews.add_source(pdf_path, content_hash, uploaded_document.gdrive_id)
+            uploaded_document.picture_url = self.previews.url_for(uploaded_document.gdrive_id)
 
-        response_data: dict = await self._send_to_gdrive(data)
-        uploaded_document = UploadedDocument(**response_data)
-
-        picture_url = await self._save_pdf_picture(contents, f"{uploaded_document.gdrive_id}.png")
-        uploaded_document.picture_url = picture_url
+        if self._on_upload is not None:
+            await self._on_upload(uploaded_document)
 
         return uploaded_document
+
+    async def upload_files(self, files: list[UploadFile], amo_id: int, doc_id: int | str) -> list[UploadResult]:
+        """
+        Загружает несколько файлов одновременно, не больше request_concurrency за раз.
+        Ошибка одного файла не прерывает остальные: для каждого файла возвращается свой итог, в порядке files.
+        """
+        request_slots = asyncio.Semaphore(self.request_concurrency)
+
+        async def upload_one(index: int, file: UploadFile) -> UploadResult:
+            async with request_slots:
+                logger.debug(f"Загрузка:  Начинаем загрузку файла {index}")
+                try:
+                    document = await self.upload_file(file, amo_id, doc_id)
+                except HTTPException as error:
+                    return UploadResult(filename=file.filename, error=str(error.detail))
+                except Exception as error:
+                    logger.error(f"Загрузка: Не удалось загрузить файл {file.filename} пользователя {amo_id}: {error!r}")
+                    return UploadResult(filename=file.filename, error="Не удалось загрузить файл, попробуйте еще раз")
+
+                return UploadResult(filename=file.filename, document=document)
+
+        return list(await asyncio.gather(*(upload_one(index, file) for index, file in enumerate(files, start=1))))
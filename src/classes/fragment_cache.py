@@ -0,0 +1,68 @@
+import hashlib
+import os
+from typing import Any
+
+from jinja2 import pass_context
+from jinja2.runtime import Context
+from markupsafe import Markup
+
+from src.classes.ttl_cache import TTLCache
+
+
+def version_of(*inputs: Any) -> str:
+    """Версия фрагмента – хеш всего, что он выводит. Входы должны иметь стабильный repr (модели, кортежи, строки)"""
+    return hashlib.sha256(repr(inputs).encode()).hexdigest()[:32]
+
+
+def folder_fingerprint(folder: str) -> str:
+    """Хеш путей и содержимого всех файлов папки: одинаковый у всех воркеров и перезапусков на одной версии кода"""
+    digest = hashlib.sha256()
+    for root, dirs, files in os.walk(folder):
+        dirs.sort()
+        for file_name in sorted(files):
+            path = os.path.join(root, file_name)
+            digest.update(os.path.relpath(path, folder).encode())
+            with open(path, "rb") as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()[:16]
+
+
+def etag_matches(if_none_match: str | None, etag: str) -> bool:
+    """Проверяет заголовок If-None-Match, в том числе список тегов, W/-теги и *"""
+    if not if_none_match:
+        return False
+    for candidate in if_none_match.split(","):
+        candidate = candidate.strip().removeprefix("W/")
+        if candidate in (etag, "*"):
+            return True
+    return False
+
+
+class FragmentCache:
+    """
+    Готовый HTML секций страницы по версии их входных данных: пока данные секции не поменялись,
+    шаблон не рендерится, а из кеша берется уже собранный фрагмент.
+    В шаблоне: {{ fragment("sections/docs.html", versions.docs) }} вместо {% include %}.
+    """
+
+    def __init__(self, ttl: float, maxsize: int, generation: str = ""):
+        self.cache: TTLCache = TTLCache(ttl=ttl, maxsize=maxsize, name="fragments")
+
+        # Версия шаблонов входит в ETag: после деплоя с другими шаблонами старые ETag не совпадут,
+        # а воркеры одной версии отдают одинаковые ETag и отвечают 304 на перезагрузки друг друга
+        self.generation: str = generation
+
+    def etag(self, *versions: Any) -> str:
+        return f'"{version_of(self.generation, *versions)}"'
+
+    @pass_context
+    def render(self, context: Context, template_name: str, version: str) -> Markup:
+        key = (template_name, version)
+        html: Markup | None = self.cache.get(key)
+        if html is None:
+            # Как {% include %}: секция видит весь контекст страницы. render() не зовем,
+            # чтобы время секций не считалось отдельным рендером в метриках и Server-Timing
+            template = context.environment.get_template(template_name)
+            html = Markup("".join(template.root_render_func(template.new_context(context.get_all(), shared=True))))
+            self.cache.set(key, html)
+        return html
@@ -1,10 +1,22 @@
 import asyncio
+import hashlib
 import logging
+import os
+import pickle
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from types import MappingProxyType
+from typing import Any, Callable, Mapping
+
 import httpx
 
-from config import CUSTOMERS_URL, SPECIALITIES_URL, DOCUMENTS_URL, FAQ_URL, GROUPS_URL, EVENTS_URL, CONFIG_URL, logger, \
-    GDRIVE_URL
+from config import SPECIALITIES_URL, DOCUMENTS_URL, FAQ_URL, GROUPS_URL, EVENTS_URL, CONFIG_URL, logger, \
+    GDRIVE_URL, CATALOG_SNAPSHOT_PATH, UPLOADS_CACHE_TTL, UPLOADS_CACHE_SIZE
 from src.classes.amo.types import UploadedDocDict
+from src.classes.http_transports import HttpTransports, UpstreamConfig
+from src.classes.ttl_cache import TTLCache
+from src.classes.upload_generations import UploadGenerations
 from src.models.customer import Customer
 from src.models.document import Document, UploadedDocument
 from src.models.faq import FAQ
@@ -12,20 +24,101 @@ from src.models.group import Group, Person, GroupEvent
 from src.models.speciality import Speciality
 
 
+@dataclass(frozen=True)
+class CatalogSnapshot:
+    """
+    Неизменяемый снимок каталога из гугл-таблиц. Общий для всех запросов,
+    поэтому и сам снимок, и модели внутри него заморожены, а обновление – это замена снимка целиком.
+    """
+    config: Mapping[str, str] = field(default_factory=lambda: MappingProxyType({}))
+    specialities: Mapping[int, Speciality] = field(default_factory=lambda: MappingProxyType({}))
+    documents: Mapping[int, Document] = field(default_factory=lambda: MappingProxyType({}))
+    faq: tuple[FAQ, ...] = ()
+    groups: Mapping[str, Group] = field(default_factory=lambda: MappingProxyType({}))
+    version: str = ""
+
+
+# Версия формата снимка на диске. Поднимаем, если меняется структура CatalogSnapshot или DatasetState
+SNAPSHOT_FORMAT = 1
+
+
+def _models_fingerprint() -> str:
+    """Отпечаток полей моделей каталога: снимок, сохраненный старой версией кода, не будет подхвачен"""
+    models = (Document, UploadedDocument, Speciality, FAQ, Group, GroupEvent, Person)
+    fields = ";".join(f"{model.__name__}:{','.join(model.model_fields)}:{','.join(model.__private_attributes__)}"
+                      for model in models)
+    return hashlib.sha256(fields.encode()).hexdigest()
+
+
+@dataclass
+class DatasetState:
+    """Последняя загруженная версия одного листа таблицы: хеш содержимого и уже разобранные модели"""
+    digest: str
+    etag: str | None
+    value: Any
+    changed: bool = True
+    seconds: float = 0.0
+
+
+@dataclass
+class RefreshState:
+    """Состояние фонового обновления каталога, показывается в /refresh"""
+    is_running: bool = False
+    last_started_at: datetime | None = None
+    last_success_at: datetime | None = None
+    last_error: str | None = None
+
+
 class GDriveFetcher:
 
-    def __init__(self):
+    # Имя апстрима в HttpTransports
+    UPSTREAM = "gas"
+
+    def __init__(self, snapshot_path: str | None = CATALOG_SNAPSHOT_PATH, transports: HttpTransports | None = None,
+                 upload_generations: UploadGenerations | None = None):
 
-        self.client = httpx.AsyncClient(timeout=30.0)
+        self.transports: HttpTransports = transports or HttpTransports(
+            {self.UPSTREAM: UpstreamConfig(read_timeout=30.0, follow_redirects=True)})
 
         # Данные, которые будут закешированы
+        self.catalog: CatalogSnapshot = CatalogSnapshot()
+
+        self.snapshot_path: str | None = snapshot_path
+        self.refresh_state: RefreshState = RefreshState()
+        self.datasets: dict[str, DatasetState] = {}
+        self._groups_assembled: tuple[tuple[str, str], dict[str, Group]] | None = None
+        self._refresh_lock = asyncio.Lock()
 
-        self.specialities: dict[int, Speciality] = {}
-        self.documents: dict[int, Document] = {}
         self.customers: dict[int, Customer] = {}
-        self.groups: dict[int, Group] = {}
-        self.faq: list[FAQ] = []
-        self.config: dict[str, str] = {}
+
+        # Загрузки клиентов по (amo_id, поколение). DocManager дописывает сюда новые файлы сразу после загрузки,
+        # а поколение из общей базы говорит остальным воркерам, что их список устарел. Без базы поколение всегда 0
+        self.uploads: TTLCache = TTLCache(ttl=UPLOADS_CACHE_TTL, maxsize=UPLOADS_CACHE_SIZE, name="gas_uploads")
+        self.upload_generations: UploadGenerations | None = upload_generations
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        return self.transports.get(self.UPSTREAM)
+
+    @property
+    def config(self) -> Mapping[str, str]:
+        return self.catalog.config
+
+    @property
+    def specialities(self) -> Mapping[int, Speciality]:
+        return self.catalog.specialities
+
+    @property
+    def documents(self) -> Mapping[int, Document]:
+        return self.catalog.documents
+
+    @property
+    def faq(self) -> tuple[FAQ, ...]:
+        return self.catalog.faq
+
+    @property
+    def groups(self) -> Mapping[str, Group]:
+        return self.catalog.groups
 
     async def preload(self):
 
@@ -37,37 +130,225 @@ class GDriveFetcher:
             self.get_all_groups(),
             return_exceptions=False,
         )
-        logger.info("All data recached")
+        config, specialities, documents, faq, groups = results
+
+        changed = [name for name, dataset in self.datasets.items() if dataset.changed]
+        timings = ", ".join(f"{name} {dataset.seconds * 1000:.0f} мс" for name, dataset in self.datasets.items())
+        logger.info(f"All data recached: изменено {len(changed)}, без изменений {len(self.datasets) - len(changed)} "
+                    f"({', '.join(changed) or '-'}); {timings}")
+
+        # Листы грузятся параллельно и попадают в datasets в порядке ответов, поэтому версию считаем по именам,
+        # иначе у воркеров с одинаковыми данными версии (и ETag профиля) не совпадали бы
+        digests = "".join(dataset.digest for _, dataset in sorted(self.datasets.items()))
+        version = hashlib.sha256(digests.encode()).hexdigest()
+        if version == self.catalog.version:
+            return
+
+        # Подменяем снимок одним присваиванием: запросы видят либо старый каталог, либо новый целиком
+        self.catalog = CatalogSnapshot(
+            config=MappingProxyType(config),
+            specialities=MappingProxyType(specialities),
+            documents=MappingProxyType(documents),
+            faq=tuple(faq),
+            groups=MappingProxyType(groups),
+            version=version,
+        )
+
+        if self.snapshot_path:
+            # Свежий каталог уже отдается, поэтому ошибка записи снимка не делает обновление неудачным
+            try:
+                await asyncio.to_thread(self.save_snapshot)
+            except Exception as error:
+                logger.error(f"Не удалось сохранить снимок каталога: {error!r}")
+
+    # СНИМОК НА ДИСКЕ
+
+    def save_snapshot(self):
+        """Сохраняет каталог и состояние листов на диск, чтобы следующий запуск не ждал гугл-таблицы"""
+
+        catalog = self.catalog
+        payload = {
+            "format": SNAPSHOT_FORMAT,
+            "models": _models_fingerprint(),
+            "saved_at": datetime.now(timezone.utc),
+            "catalog": {
+                "config": dict(catalog.config),
+                "specialities": dict(catalog.specialities),
+                "documents": dict(catalog.documents),
+                "faq": catalog.faq,
+                "groups": dict(catalog.groups),
+                "version": catalog.version,
+            },
+            "datasets": self.datasets,
+            "groups_assembled": self._groups_assembled,
+        }
+
+        # Пишем во временный файл и подменяем, чтобы упавшая запись не испортила прошлый снимок
+        os.makedirs(os.path.dirname(self.snapshot_path) or ".", exist_ok=True)
+        tmp_path = f"{self.snapshot_path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(payload, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.snapshot_path)
+
+    def load_snapshot(self) -> bool:
+        """Поднимает каталог из снимка на диске. Возвращает False, если снимка нет или он от другой версии"""
+
+        if not self.snapshot_path or not os.path.exists(self.snapshot_path):
+            return False
+
+        try:
+            with open(self.snapshot_path, "rb") as f:
+                payload = pickle.load(f)
+
+            if payload.get("format") != SNAPSHOT_FORMAT or payload.get("models") != _models_fingerprint():
+                logger.warning("Снимок каталога от другой версии приложения, пропускаем")
+                return False
+
+            catalog = payload["catalog"]
+            self.catalog = CatalogSnapshot(
+                config=MappingProxyType(catalog["config"]),
+                specialities=MappingProxyType(catalog["specialities"]),
+                documents=MappingProxyType(catalog["documents"]),
+                faq=catalog["faq"],
+                groups=MappingProxyType(catalog["groups"]),
+                version=catalog["version"],
+            )
+            self.datasets = payload["datasets"]
+            self._groups_assembled = payload["groups_assembled"]
+
+        except Exception as error:
+            logger.error(f"Не удалось прочитать снимок каталога: {error!r}")
+            return False
+
+        logger.info(f"Каталог загружен из снимка от {payload['saved_at']:%Y-%m-%d %H:%M:%S} UTC")
+        return True
+
+    async def _load_dataset(self, name: str, url: str, parse: Callable[[Any], Any]) -> Any:
+        """
+        Загружает лист таблицы. Если содержимое не изменилось (по ETag или хешу ответа),
+        пропускает разбор JSON и сборку моделей и возвращает прошлый результат.
+        """
+        started_at = time.perf_counter()
+        previous: DatasetState | None = self.datasets.get(name)
+
+        headers = {}
+        if previous is not None and previous.etag:
+            headers["If-None-Match"] = previous.etag
 
-        self.config, self.specialities, self.documents, self.faq, self.groups = results
+        response = await self.client.get(url, headers=headers, follow_redirects=True)
+
+        if previous is not None and response.status_code == 304:
+            digest, etag = previous.digest, previous.etag
+        else:
+            response.raise_for_status()
+            digest, etag = hashlib.sha256(response.content).hexdigest(), response.headers.get("ETag")
+
+        if previous is not None and previous.digest == digest:
+            dataset = DatasetState(digest, etag, previous.value, changed=False)
+        else:
+            dataset = DatasetState(digest, etag, parse(response.json()), changed=True)
+
+        dataset.seconds = time.perf_counter() - started_at
+        self.datasets[name] = dataset
+        return dataset.value
+
+    async def refresh(self) -> bool:
+        """
+        Перезагружает каталог, если он уже не обновляется прямо сейчас.
+        При ошибке остается последний удачный снимок, а ошибка попадает в refresh_state.
+        """
+        if self._refresh_lock.locked():
+            return False
+
+        async with self._refresh_lock:
+            self.refresh_state.is_running = True
+            self.refresh_state.last_started_at = datetime.now(timezone.utc)
+            try:
+                await self.preload()
+            except Exception as error:
+                logger.error(f"Не удалось обновить каталог, оставляем предыдущий: {error!r}")
+                self.refresh_state.last_error = repr(error)
+                return False
+            finally:
+                self.refresh_state.is_running = False
+
+            self.refresh_state.last_success_at = datetime.now(timezone.utc)
+            self.refresh_state.last_error = None
+            return True
+
+    async def run_refresher(self, interval: float):
+        """Фоновая задача: обновляет каталог раз в interval секунд, запускается в lifespan"""
+        while True:
+            # Пока каталога нет совсем (гугл не ответил на старте), пробуем чаще
+            await asyncio.sleep(interval if self.catalog.version else min(interval, 30))
+            await self.refresh()
+
+    # ЗАГРУЗКИ
 
     async def get_document_uploads(self, amo_id, doc_id) -> list[UploadedDocument]:
-        response = await self.client.get(f"{CUSTOMERS_URL}/{amo_id}/{doc_id}", follow_redirects=True)
-        docs_data = response.json()
-        return [UploadedDocument(**doc) for doc in docs_data]
+        """Загрузки одного документа клиента, берутся из того же индекса, что и все загрузки"""
+        uploads = await self.get_all_uploads(amo_id)
+        return [upload for upload in uploads if str(upload.doc_id) == str(doc_id)]
 
     async def get_all_uploads(self, amo_id) -> list[UploadedDocument]:
+        generation = await self.upload_generations.get(amo_id) if self.upload_generations else 0
+        if generation is None:
+            # Не знаем, свежий ли кеш, – читаем загрузки из GAS напрямую
+            return list(await self._fetch_uploads(amo_id))
+
+        uploads: tuple[UploadedDocument, ...] = await self.uploads.get_or_fetch((amo_id, generation),
+                                                                                lambda: self._fetch_uploads(amo_id))
+        return list(uploads)
+
+    async def _fetch_uploads(self, amo_id) -> tuple[UploadedDocument, ...]:
 
         response = await self.client.get(f"{GDRIVE_URL}/alldocs/{amo_id}", follow_redirects=True)
         docs_data: list[UploadedDocDict] = response.json()
-        return [UploadedDocument(**doc) for doc in docs_data]
+        return tuple(UploadedDocument(**doc) for doc in docs_data)
+
+    async def add_upload(self, upload: UploadedDocument):
+        """
+        Дописывает только что загруженный файл в индекс, чтобы не перезапрашивать загрузки из GAS,
+        и поднимает поколение загрузок клиента, чтобы другие воркеры перечитали свой список
+        """
+
+        amo_id = upload.customer_id
+        if self.upload_generations is None:
+            previous = generation = 0
+        else:
+            generation = await self.upload_generations.bump(amo_id)
+            if generation is None:
+                return  # База недоступна: пока она не ответит, загрузки читаются из GAS без кеша
+            previous = generation - 1
+
+        # Дописываем, только если у нас список ровно предыдущего поколения: иначе в нем нет чужих загрузок
+        cached: tuple[UploadedDocument, ...] | None = self.uploads.get((amo_id, previous))
+
+        if cached is None:
+            # Индекса нет или он еще грузится и может не увидеть новый файл – пусть перечитается целиком
+            self.uploads.invalidate((amo_id, generation))
+        else:
+            self.uploads.set((amo_id, generation), cached + (upload,))
 
     async def get_all_faqs(self) -> list[FAQ]:
 
-        response = await self.client.get(FAQ_URL, follow_redirects=True)
-        faq_data = response.json()
-        faq: list[FAQ] = [FAQ(**faq_item) for faq_item in faq_data]
+        faq: list[FAQ] = await self._load_dataset("faq", FAQ_URL, self._parse_faqs)
         return faq
 
+    @staticmethod
+    def _parse_faqs(faq_data) -> list[FAQ]:
+        return [FAQ(**faq_item) for faq_item in faq_data]
+
     # СПЕЦИАЛЬНОСТИ
 
     async def get_all_specialties(self) -> dict[int, Speciality]:
 
         logger.info("Caching specialities")
-        response = await self.client.get(SPECIALITIES_URL, follow_redirects=True)
-        data = response.json()
-        specialities = {spec_data["id"]: Speciality(**spec_data) for spec_data in data}
-        return specialities
+        return await self._load_dataset("specialities", SPECIALITIES_URL, self._parse_specialities)
+
+    @staticmethod
+    def _parse_specialities(data) -> dict[int, Speciality]:
+        return {spec_data["id"]: Speciality(**spec_data) for spec_data in data}
 
     def get_specialty(self, specialty_id):
         """
@@ -82,10 +363,29 @@ class GDriveFetcher:
     async def get_all_groups(self):
 
         logger.info("Caching groups")
-        response = await self.client.get(GROUPS_URL, follow_redirects=True)
-        all_groups = response.json()
+        groups_data, events = await asyncio.gather(
+            self._load_dataset("groups", GROUPS_URL, self._parse_groups),
+            self._load_dataset("events", EVENTS_URL, self._parse_events),
+        )
+
+        # Группы собираются из двух листов, пересобираем их, только если поменялся хотя бы один
+        key = (self.datasets["groups"].digest, self.datasets["events"].digest)
+        if self._groups_assembled is not None and self._groups_assembled[0] == key:
+            return self._groups_assembled[1]
+
+        for group_id in events.keys() - groups_data.keys():
+            logging.warn(f"Не найдена группа {group_id}")
+
+        groups = {group_id: Group(**group_data, events=events.get(group_id, []))
+                  for group_id, group_data in groups_data.items()}
+
+        self._groups_assembled = (key, groups)
+        return groups
+
+    @staticmethod
+    def _parse_groups(all_groups) -> dict[str, dict]:
 
-        groups = {}
+        groups_data = {}
         for gr in all_groups:
 
             group_id = gr["id"]
@@ -116,22 +416,20 @@ class GDriveFetcher:
                 tg=gr.get("expert_tg"),
             )
 
-            groups[group_id] = (Group(id=group_id, chat_tg=chat_tg, curator=curator, teacher=teacher, expert=expert))
+            groups_data[group_id] = {"id": group_id, "chat_tg": chat_tg, "curator": curator, "teacher": teacher,
+                                     "expert": expert}
 
-        # Досыпаем к каждой группе ее события
+        return groups_data
 
-        response = await self.client.get(EVENTS_URL, follow_redirects=True)
-        all_events = response.json()
+    @staticmethod
+    def _parse_events(all_events) -> dict[str, list[GroupEvent]]:
+        """Раскладывает события по группам, сортирует их по началу уже сама модель Group"""
 
+        events: dict[str, list[GroupEvent]] = {}
         for event in all_events:
-            group_id = event["group_id"]
+            events.setdefault(event["group_id"], []).append(GroupEvent(**event))
 
-            if groups.get(group_id):
-                groups[group_id].events.append(GroupEvent(**event))
-            else:
-                logging.warn(f"Не найдена группа {group_id}")
-
-        return groups
+        return events
 
     def get_group(self, group_id) -> Group | None:
         """
@@ -151,27 +449,31 @@ class GDriveFetcher:
 
     async def get_all_documents(self) -> dict[int, Document]:
         logger.info("Caching documents")
-        response = await self.client.get(DOCUMENTS_URL, follow_redirects=True)
-        data = response.json()
-        documents = {doc_data["id"]: Document(**doc_data) for doc_data in data}
-        return documents
+        return await self._load_dataset("documents", DOCUMENTS_URL, self._parse_documents)
+
+    @staticmethod
+    def _parse_documents(data) -> dict[int, Document]:
+        return {doc_data["id"]: Document(**doc_data) for doc_data in data}
 
     def get_documents_by_indices(self, indices, docs_ready) -> dict[int, Document]:
         """
-        Возвращает словарь документов по индексам и отмечает загруженные
+        Возвращает словарь документов по индексам и отмечает загруженные.
+        Документы каталога не меняем: клиент получает свои копии со своим статусом загрузки.
         """
         docs: dict[int, Document] = {}
         for index in indices:
             doc: Document = self.get_document(index)
-            if doc.id in docs_ready:
-                doc.is_uploaded = True
-            docs[doc.id] = doc
+            if doc is None:
+                logger.warning(f"Документ {index} не найден в каталоге")
+                continue
+            docs[doc.id] = doc.model_copy(update={"is_uploaded": doc.id in docs_ready})
 
         return docs
 
     async def get_all_config(self):
         logger.info("Caching configs")
-        response = await self.client.get(CONFIG_URL, follow_redirects=True)
-        data = response.json()
-        config = {conf_data["key"]: conf_data["value"] for conf_data in data}
-        return config
+        return await self._load_dataset("config", CONFIG_URL, self._parse_config)
+
+    @staticmethod
+    def _parse_config(data) -> dict[str, str]:
+        return {conf_data["key"]: conf_data["value"] for conf_data in data}
@@ -0,0 +1,120 @@
+import asyncio
+import importlib.util
+import time
+from dataclasses import dataclass
+
+import httpx
+from loguru import logger
+
+from src.classes import server_timing
+from src.classes.metrics import MetricsRegistry
+
+
+@dataclass(frozen=True)
+class UpstreamConfig:
+    """Настройки соединений с одним внешним сервисом"""
+    max_connections: int = 10
+    max_keepalive: int = 5
+    keepalive_expiry: float = 30.0  # Сколько секунд держим простаивающее соединение, чтобы не повторять TLS
+    connect_timeout: float = 5.0
+    read_timeout: float = 15.0
+    write_timeout: float = 15.0
+    http2: bool = False  # Работает, только если установлен пакет h2 (pip install httpx[http2])
+    follow_redirects: bool = False
+
+
+def http2_available() -> bool:
+    return importlib.util.find_spec("h2") is not None
+
+
+class InstrumentedTransport(httpx.AsyncBaseTransport):
+    """
+    Транспорт-обертка: пишет в метрики время до ответа, статус и число запросов в полете для апстрима,
+    а время запроса еще и в Server-Timing текущего входящего запроса
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, upstream: str, metrics: "HttpMetrics"):
+        self.transport: httpx.AsyncBaseTransport = transport
+        self.upstream: str = upstream
+        self.metrics: HttpMetrics = metrics
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.metrics.in_flight.inc(upstream=self.upstream)
+        started_at = time.perf_counter()
+        status = "error"
+        try:
+            response = await self.transport.handle_async_request(request)
+            status = str(response.status_code)
+            return response
+        except Exception as error:
+            status = type(error).__name__  # ConnectTimeout, ReadError и т.п.
+            raise
+        finally:
+            duration = time.perf_counter() - started_at
+            self.metrics.in_flight.dec(upstream=self.upstream)
+            self.metrics.requests.inc(upstream=self.upstream, method=request.method, status=status)
+            self.metrics.duration.observe(duration, upstream=self.upstream, method=request.method)
+            server_timing.record(self.upstream, duration)
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+class HttpMetrics:
+    """Метрики исходящих запросов, общие для всех апстримов"""
+
+    def __init__(self, registry: MetricsRegistry):
+        self.duration = registry.histogram("http_client_request_duration_seconds",
+                                           "Время до получения ответа от внешнего сервиса", ("upstream", "method"))
+        self.requests = registry.counter("http_client_requests_total",
+                                         "Запросы к внешним сервисам по статусу ответа или типу ошибки",
+                                         ("upstream", "method", "status"))
+        self.in_flight = registry.gauge("http_client_requests_in_flight",
+                                        "Запросы к внешним сервисам, ожидающие ответа", ("upstream",))
+
+
+class HttpTransports:
+    """
+    Общие httpx-клиенты для всех внешних сервисов: по клиенту и пулу соединений на апстрим.
+    Клиенты создаются при запуске (или при первом обращении) и закрываются при остановке приложения.
+    Если передан реестр метрик, каждый запрос попадает в метрики своего апстрима.
+    """
+
+    def __init__(self, upstreams: dict[str, UpstreamConfig], metrics: MetricsRegistry | None = None):
+        self.upstreams: dict[str, UpstreamConfig] = upstreams
+        self.metrics: HttpMetrics | None = HttpMetrics(metrics) if metrics is not None else None
+        self._clients: dict[str, httpx.AsyncClient] = {}
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        client = self._clients.get(name)
+        if client is None or client.is_closed:
+            client = self._clients[name] = self._build(name, self.upstreams[name])
+        return client
+
+    def _build(self, name: str, upstream: UpstreamConfig) -> httpx.AsyncClient:
+        http2 = upstream.http2 and http2_available()
+        if upstream.http2 and not http2:
+            logger.debug(f"HTTP: Для {name} HTTP/2 выключен, пакет h2 не установлен")
+
+        limits = httpx.Limits(max_connections=upstream.max_connections,
+                              max_keepalive_connections=upstream.max_keepalive,
+                              keepalive_expiry=upstream.keepalive_expiry)
+        timeout = httpx.Timeout(connect=upstream.connect_timeout, read=upstream.read_timeout,
+                                write=upstream.write_timeout, pool=upstream.connect_timeout)
+
+        transport: httpx.AsyncBaseTransport = httpx.AsyncHTTPTransport(limits=limits, http2=http2)
+        if self.metrics is not None:
+            transport = InstrumentedTransport(transport, name, self.metrics)
+
+        return httpx.AsyncClient(transport=transport, timeout=timeout, follow_redirects=upstream.follow_redirects)
+
+    def open(self):
+        """Создает клиенты всех апстримов, вызывается в lifespan"""
+        for name in self.upstreams:
+            self.get(name)
+        logger.info(f"HTTP: Клиенты готовы: {', '.join(self._clients)} (HTTP/2: {http2_available()})")
+
+    async def aclose(self):
+        """Закрывает все соединения, вызывается при остановке приложения"""
+        clients, self._clients = list(self._clients.values()), {}
+        await asyncio.gather(*(client.aclose() for client in clients), return_exceptions=True)
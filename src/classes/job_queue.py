@@ -0,0 +1,285 @@
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable
+
+from loguru import logger
+
+JobHandler = Callable[[dict[str, Any]], Awaitable[None]]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    run_at REAL NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    locked_by TEXT,
+    locked_until REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_due ON jobs (status, run_at);
+"""
+
+# Колонки, добавленные после первой версии схемы: в старую базу дописываются при подключении
+MIGRATIONS = {
+    "locked_by": "ALTER TABLE jobs ADD COLUMN locked_by TEXT",
+    "locked_until": "ALTER TABLE jobs ADD COLUMN locked_until REAL",
+}
+
+
+@dataclass
+class Job:
+    """Фоновая задача: что сделать (kind), с какими данными (payload) и как идут дела"""
+    id: str
+    kind: str
+    payload: dict[str, Any]
+    status: str  # pending, running, done, failed
+    attempts: int = 0
+    error: str | None = None
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in ("done", "failed")
+
+
+class JobQueue:
+    """
+    Очередь фоновых задач в SQLite: задачи лежат на диске и переживают перезапуск приложения.
+    База общая для всех воркеров uvicorn, поэтому взятая задача помечается владельцем и арендой (lease),
+    которую владелец продлевает, пока выполняет задачу. Задача, чей владелец умер и аренда истекла,
+    выполнится заново в любом процессе, упавшая – повторится с экспоненциальной паузой, пока не кончатся попытки.
+    """
+
+    def __init__(self, db_path: str, max_attempts: int = 5, retry_base_delay: float = 5.0,
+                 retry_max_delay: float = 300.0, retention: float = 7 * 86400, poll_interval: float = 5.0,
+                 lease: float = 60.0):
+        self.db_path: str = db_path
+        self.max_attempts: int = max_attempts
+        self.retry_base_delay: float = retry_base_delay
+        self.retry_max_delay: float = retry_max_delay
+        self.retention: float = retention  # Сколько секунд храним завершенные задачи для страницы статуса
+        self.poll_interval: float = poll_interval
+        self.lease: float = lease  # На сколько секунд задача закрепляется за воркером, продлевается каждую треть
+
+        # Владелец взятых задач: процесс на конкретной машине
+        self.worker_id: str = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+        self._handlers: dict[str, JobHandler] = {}
+        self._wakeup = asyncio.Event()
+
+        # sqlite3 синхронный, поэтому ходим в базу из потоков, а соединение одно на всех под замком
+        self._connection: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def register(self, kind: str, handler: JobHandler):
+        """Назначает обработчик задачам вида kind"""
+        self._handlers[kind] = handler
+
+    # РАБОТА С БАЗОЙ
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+            connection.row_factory = sqlite3.Row
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+            self._migrate(connection)
+            self._connection = connection
+        return self._connection
+
+    @staticmethod
+    def _migrate(connection: sqlite3.Connection):
+        columns = {row["name"] for row in connection.execute("PRAGMA table_info(jobs)")}
+        for column, sql in MIGRATIONS.items():
+            if column in columns:
+                continue
+            try:
+                connection.execute(sql)
+            except sqlite3.OperationalError:
+                pass  # Колонку только что добавил соседний процесс
+
+    def _execute(self, sql: str, params: tuple = ()) -> list[sqlite3.Row]:
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    async def _query(self, sql: str, params: tuple = ()) -> list[sqlite3.Row]:
+        return await asyncio.to_thread(self._execute, sql, params)
+
+    @staticmethod
+    def _to_job(row: sqlite3.Row) -> Job:
+        return Job(id=row["id"], kind=row["kind"], payload=json.loads(row["payload"]), status=row["status"],
+                   attempts=row["attempts"], error=row["error"])
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    # ПУБЛИЧНЫЕ МЕТОДЫ
+
+    async def enqueue(self, kind: str, payload: dict[str, Any], delay: float = 0) -> str:
+        """Кладет задачу в очередь и возвращает ее id для опроса статуса"""
+
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        await self._query(
+            "INSERT INTO jobs (id, kind, payload, status, run_at, created_at, updated_at) "
+            "VALUES (?, ?, ?, 'pending', ?, ?, ?)",
+            (job_id, kind, json.dumps(payload, ensure_ascii=False), now + delay, now, now),
+        )
+        self._wakeup.set()
+        logger.debug(f"Задачи: {kind} {job_id} добавлена в очередь")
+        return job_id
+
+    async def get(self, job_id: str) -> Job | None:
+        rows = await self._query("SELECT * FROM jobs WHERE id = ?", (job_id,))
+        return self._to_job(rows[0]) if rows else None
+
+    async def stats(self) -> dict[str, int]:
+        """Сколько задач в каждом статусе"""
+        rows = await self._query("SELECT status, COUNT(*) AS total FROM jobs GROUP BY status")
+        return {"pending": 0, "running": 0, "done": 0, "failed": 0} | {row["status"]: row["total"] for row in rows}
+
+    async def recover(self):
+        """
+        Вызывается при запуске до воркеров: задачи с истекшей арендой (их владелец остановился) возвращаются
+        в очередь, а давно завершенные удаляются. Задачи, которые сейчас выполняют другие процессы, не трогаем.
+        """
+        now = time.time()
+        recovered = await self._query(
+            "UPDATE jobs SET status = 'pending', run_at = ?, updated_at = ?, locked_by = NULL, locked_until = NULL "
+            "WHERE status = 'running' AND (locked_until IS NULL OR locked_until < ?) RETURNING id",
+            (now, now, now),
+        )
+        await self._query("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                          (now - self.retention,))
+        pending = (await self.stats())["pending"]
+        logger.info(f"Задачи: в очереди {pending}, из них возвращено после остановки {len(recovered)}")
+
+    # ВОРКЕРЫ
+
+    async def _claim(self) -> Job | None:
+        """
+        Забирает самую раннюю задачу, которой пора выполняться, или задачу, чей владелец не продлил аренду.
+        Один UPDATE атомарен в SQLite, поэтому задачу не заберут два процесса сразу
+        """
+        now = time.time()
+        rows = await self._query(
+            "UPDATE jobs SET status = 'running', attempts = attempts + 1, locked_by = ?, locked_until = ?, "
+            "updated_at = ? "
+            "WHERE id = (SELECT id FROM jobs WHERE (status = 'pending' AND run_at <= ?) "
+            "OR (status = 'running' AND locked_until < ?) ORDER BY run_at LIMIT 1) "
+            "RETURNING *",
+            (self.worker_id, now + self.lease, now, now, now),
+        )
+        return self._to_job(rows[0]) if rows else None
+
+    async def _renew_lease(self, job: Job):
+        """Продлевает аренду задачи, пока ее выполняет обработчик"""
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            try:
+                renewed = await self._query(
+                    "UPDATE jobs SET locked_until = ? WHERE id = ? AND locked_by = ? AND status = 'running' "
+                    "RETURNING id",
+                    (time.time() + self.lease, job.id, self.worker_id),
+                )
+            except sqlite3.Error as error:
+                logger.error(f"Задачи: Не удалось продлить аренду {job.kind} {job.id}: {error!r}")
+                continue
+            if not renewed:
+                logger.warning(f"Задачи: {job.kind} {job.id} забрал другой воркер, аренда потеряна")
+                return
+
+    def _release(self, job: Job):
+        """Возвращает задачу в очередь без ожидания аренды, когда воркер останавливают посреди нее"""
+        now = time.time()
+        self._execute(
+            "UPDATE jobs SET status = 'pending', run_at = ?, updated_at = ?, locked_by = NULL, locked_until = NULL "
+            "WHERE id = ? AND locked_by = ?",
+            (now, now, job.id, self.worker_id),
+        )
+
+    async def _seconds_to_next(self) -> float:
+        rows = await self._query("SELECT MIN(run_at) AS run_at FROM jobs WHERE status = 'pending'")
+        run_at = rows[0]["run_at"]
+        if run_at is None:
+            return self.poll_interval
+        return min(max(run_at - time.time(), 0), self.poll_interval)
+
+    async def _finish(self, job: Job, error: str | None = None):
+        now = time.time()
+
+        if error is None:
+            await self._query("UPDATE jobs SET status = 'done', error = NULL, updated_at = ?, "
+                              "locked_by = NULL, locked_until = NULL WHERE id = ? AND locked_by = ?",
+                              (now, job.id, self.worker_id))
+            logger.debug(f"Задачи: {job.kind} {job.id} выполнена")
+            return
+
+        if job.attempts >= self.max_attempts:
+            await self._query("UPDATE jobs SET status = 'failed', error = ?, updated_at = ?, "
+                              "locked_by = NULL, locked_until = NULL WHERE id = ? AND locked_by = ?",
+                              (error, now, job.id, self.worker_id))
+            logger.error(f"Задачи: {job.kind} {job.id} не выполнена за {job.attempts} попыток: {error}")
+            return
+
+        delay = min(self.retry_base_delay * 2 ** (job.attempts - 1), self.retry_max_delay)
+        await self._query("UPDATE jobs SET status = 'pending', error = ?, run_at = ?, updated_at = ?, "
+                          "locked_by = NULL, locked_until = NULL WHERE id = ? AND locked_by = ?",
+                          (error, now + delay, now, job.id, self.worker_id))
+        logger.warning(f"Задачи: {job.kind} {job.id} упала ({error}), повтор через {delay:.0f} с")
+
+    async def _run(self, job: Job):
+        handler = self._handlers.get(job.kind)
+        if handler is None:
+            await self._finish(job, f"Нет обработчика для задач {job.kind}")
+            return
+
+        renewer = asyncio.create_task(self._renew_lease(job))
+        try:
+            await handler(job.payload)
+        except asyncio.CancelledError:
+            self._release(job)
+            raise
+        except Exception as error:
+            await self._finish(job, repr(error))
+        else:
+            await self._finish(job)
+        finally:
+            renewer.cancel()
+
+    async def run_worker(self):
+        """
+        Выполняет задачи одну за другой, пока воркер не отменят.
+        Если воркер отменили посреди задачи, она сразу возвращается в очередь, а если процесс умер –
+        ее заберет любой воркер, когда истечет аренда.
+        """
+        while True:
+            self._wakeup.clear()
+            try:
+                job = await self._claim()
+                if job is not None:
+                    await self._run(job)
+                    continue
+                timeout = await self._seconds_to_next()
+            except sqlite3.Error as error:
+                logger.error(f"Задачи: Ошибка базы очереди: {error!r}")
+                timeout = self.poll_interval
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
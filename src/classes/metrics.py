@@ -0,0 +1,190 @@
+import inspect
+import time
+from contextlib import contextmanager
+from typing import Any, Awaitable, Callable
+
+from jinja2 import Template
+
+from src.classes import server_timing
+
+# Границы бакетов гистограмм в секундах: от быстрых ответов из кеша до медленных загрузок на GAS
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Collector = Callable[[], dict[str, float] | Awaitable[dict[str, float]]]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """Метрика с набором меток. Значения хранятся по кортежу значений меток в порядке labelnames"""
+
+    type: str = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()):
+        self.name: str = name
+        self.documentation: str = documentation
+        self.labelnames: tuple[str, ...] = labelnames
+        self._values: dict[tuple[str, ...], Any] = {}
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Метрика {self.name} ждет метки {self.labelnames}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> list[tuple[str, dict[str, str], float]]:
+        return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value: float, **labels: str):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels: str):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets: tuple[float, ...] = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value: float, **labels: str):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            state = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                state["buckets"][i] += 1
+                break
+        state["sum"] += value
+        state["count"] += 1
+
+    @contextmanager
+    def time(self, **labels: str):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started_at, **labels)
+
+    def samples(self) -> list[tuple[str, dict[str, str], float]]:
+        samples = []
+        for key, state in self._values.items():
+            labels = dict(zip(self.labelnames, key))
+            cumulative = 0
+            for bound, amount in zip(self.buckets, state["buckets"]):
+                cumulative += amount
+                samples.append((f"{self.name}_bucket", {**labels, "le": _format_value(bound)}, cumulative))
+            samples.append((f"{self.name}_sum", labels, state["sum"]))
+            samples.append((f"{self.name}_count", labels, state["count"]))
+        return samples
+
+
+class MetricsRegistry:
+    """
+    Метрики приложения в памяти процесса, отдаются на /metrics в текстовом формате Prometheus.
+    Счетчики и гистограммы пишутся по ходу работы, а состояние очередей, кешей и лимитера
+    снимается коллекторами в момент запроса метрик из их stats.
+    """
+
+    def __init__(self, prefix: str = ""):
+        self.prefix: str = prefix
+        self._metrics: dict[str, Metric] = {}
+        self._collectors: list[tuple[str, Collector, dict[str, str]]] = []
+
+    def _full_name(self, name: str) -> str:
+        return f"{self.prefix}_{name}" if self.prefix else name
+
+    def _register(self, metric: Metric) -> Metric:
+        if metric.name in self._metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        return self._register(Counter(self._full_name(name), documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Gauge:
+        return self._register(Gauge(self._full_name(name), documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(self._full_name(name), documentation, labelnames, buckets))
+
+    def add_collector(self, name: str, collect: Collector, labels: dict[str, str] | None = None):
+        """
+        Подключает stats-словарь компонента: каждый ключ станет метрикой {name}_{ключ}.
+        Ключи на _total отдаются как счетчики, остальные – как текущие значения
+        """
+        self._collectors.append((self._full_name(name), collect, labels or {}))
+
+    async def _collect(self) -> dict[str, tuple[str, list[tuple[dict[str, str], float]]]]:
+        collected: dict[str, tuple[str, list[tuple[dict[str, str], float]]]] = {}
+        for name, collect, labels in self._collectors:
+            stats = collect()
+            if inspect.isawaitable(stats):
+                stats = await stats
+            for key, value in stats.items():
+                metric_type = "counter" if key.endswith("_total") else "gauge"
+                collected.setdefault(f"{name}_{key}", (metric_type, []))[1].append((labels, value))
+        return collected
+
+    async def render(self) -> str:
+        lines: list[str] = []
+
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+        for name, (metric_type, samples) in (await self._collect()).items():
+            lines.append(f"# TYPE {name} {metric_type}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+        return "\n".join(lines) + "\n"
+
+
+def timed_template_class(histogram: Histogram) -> type[Template]:
+    """Класс шаблонов Jinja, который пишет время рендера каждого шаблона в гистограмму и в Server-Timing"""
+
+    class TimedTemplate(Template):
+        def render(self, *args, **kwargs) -> str:
+            with histogram.time(template=self.name or "<string>"), server_timing.span("render"):
+                return super().render(*args, **kwargs)
+
+    return TimedTemplate
@@ -0,0 +1,16 @@
+import fitz
+
+
+# Точка входа процессов рендера превью. Модуль намеренно без импортов приложения (config, dependencies):
+# дочерний процесс пула импортирует его заново и не должен поднимать логгеры, папки и клиенты
+def render_pdf_thumbnail(pdf_path: str, page_number: int, width: int, image_format: str, quality: int) -> bytes:
+    """
+    Рендерит страницу PDF сразу в нужную ширину и кодирует в WebP/JPEG.
+    Выполняется в отдельном процессе, поэтому функция модульная.
+    """
+
+    with fitz.open(pdf_path, filetype="pdf") as pdf_document:
+        page = pdf_document[min(page_number, len(pdf_document) - 1)]
+        zoom = width / page.rect.width
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+        return pix.pil_tobytes(format=image_format.upper(), quality=quality)
@@ -0,0 +1,58 @@
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from loguru import logger
+
+from src.classes.pdf_thumbnail import render_pdf_thumbnail
+
+
+class PreviewRenderer:
+    """
+    Рендер превью PDF в пуле процессов: PyMuPDF держит GIL и на больших сканах
+    блокировал бы event loop для всех остальных запросов.
+    """
+
+    def __init__(self, max_workers: int = 2, page: int = 0, timeout: float = 10.0,
+                 image_format: str = "webp", quality: int = 80):
+        self.max_workers: int = max_workers
+        self.page: int = page
+        self.timeout: float = timeout
+        self.image_format: str = image_format
+        self.quality: int = quality
+
+        self._executor: ProcessPoolExecutor | None = None
+
+    @property
+    def executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn, а не fork: дочерние процессы не наследуют event loop и потоки приложения.
+            # Они заново импортируют главный модуль, поэтому логгеры и папки приложение настраивает при старте, а не при импорте
+            context = multiprocessing.get_context("spawn")
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=context)
+        return self._executor
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def render(self, pdf_path: str, width: int) -> bytes | None:
+        """Возвращает превью шириной width или None, если рендер упал или не уложился в timeout"""
+
+        loop = asyncio.get_running_loop()
+        try:
+            future = loop.run_in_executor(self.executor, render_pdf_thumbnail, pdf_path, self.page, width,
+                                          self.image_format, self.quality)
+            return await asyncio.wait_for(future, timeout=self.timeout)
+
+        except asyncio.TimeoutError:
+            logger.warning(f"Превью: {pdf_path} не отрендерилось за {self.timeout} с")
+        except BrokenProcessPool:
+            logger.error("Превью: Пул рендера упал, пересоздаем")
+            self._executor = None
+        except Exception as error:
+            logger.warning(f"Превью: Не удалось отрендерить {pdf_path}: {error!r}")
+
+        return None
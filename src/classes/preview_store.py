@@ -0,0 +1,122 @@
+import asyncio
+import os
+import re
+
+import aiofiles
+from loguru import logger
+
+from src.classes.preview_renderer import PreviewRenderer
+from src.classes.ttl_cache import TTLCache
+
+HASH_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+class PreviewStore:
+    """
+    Превью загруженных PDF, адресованные по sha256 содержимого: одинаковые файлы хранятся и рендерятся один раз.
+    При загрузке только запоминаем исходник и его хеш, миниатюры делаются при первом запросе и дальше лежат на диске.
+    """
+
+    def __init__(self, folder: str, renderer: PreviewRenderer, sizes: dict[str, int], image_format: str = "webp",
+                 links_cache_ttl: float = 24 * 60 * 60, links_cache_size: int = 10000):
+        self.sources_folder: str = os.path.join(folder, "sources")  # {hash}.pdf
+        self.thumbs_folder: str = os.path.join(folder, "thumbs")  # {hash}_{size}.{format}
+        self.links_folder: str = os.path.join(folder, "uploads")  # {gdrive_id} -> hash
+
+        self.renderer: PreviewRenderer = renderer
+        self.sizes: dict[str, int] = sizes
+        self.image_format: str = image_format
+
+        # Хеши загрузок по gdrive_id. Промах тоже запоминаем (пустой строкой): у загрузок, сделанных до хранилища,
+        # связи нет, и без этого каждый показ списка документов заново ходил бы на диск
+        self.links: TTLCache = TTLCache(ttl=links_cache_ttl, maxsize=links_cache_size, name="preview_links")
+        self._rendering: dict[tuple[str, str], asyncio.Task] = {}
+
+    @property
+    def media_type(self) -> str:
+        return f"image/{self.image_format}"
+
+    def source_path(self, content_hash: str) -> str:
+        return os.path.join(self.sources_folder, f"{content_hash}.pdf")
+
+    def thumbnail_path(self, content_hash: str, size: str) -> str:
+        return os.path.join(self.thumbs_folder, f"{content_hash}_{size}.{self.image_format}")
+
+    def is_known(self, content_hash: str, size: str, extension: str) -> bool:
+        """Проверяет параметры из URL, прежде чем строить по ним пути на диске"""
+        return bool(HASH_PATTERN.match(content_hash)) and size in self.sizes and extension == self.image_format
+
+    def add_source(self, pdf_path: str, content_hash: str, gdrive_id: str):
+        """
+        Забирает PDF загрузки в хранилище под его хешем и связывает с ним загрузку.
+        Если такой же файл уже загружали, копия просто удаляется.
+        """
+        os.makedirs(self.sources_folder, exist_ok=True)
+        os.makedirs(self.links_folder, exist_ok=True)
+
+        source_path = self.source_path(content_hash)
+        if os.path.exists(source_path):
+            os.remove(pdf_path)
+        else:
+            os.replace(pdf_path, source_path)
+
+        link_path = os.path.join(self.links_folder, gdrive_id)
+        with open(f"{link_path}.tmp", "w") as f:
+            f.write(content_hash)
+        os.replace(f"{link_path}.tmp", link_path)
+
+        self.links.set(gdrive_id, content_hash)
+
+    def hash_for(self, gdrive_id: str) -> str | None:
+        content_hash: str | None = self.links.get(gdrive_id)
+        if content_hash is None:
+            try:
+                with open(os.path.join(self.links_folder, os.path.basename(gdrive_id))) as f:
+                    content_hash = f.read().strip()
+            except FileNotFoundError:
+                content_hash = ""
+            self.links.set(gdrive_id, content_hash)
+        return content_hash or None
+
+    def url_for(self, gdrive_id: str, size: str = "small") -> str:
+        """Адрес превью загрузки, используется в шаблонах как фильтр preview_url"""
+        content_hash = self.hash_for(gdrive_id)
+        if content_hash is None:
+            return f"/uploads/{gdrive_id}.png"  # Загрузки, сделанные до хранилища превью
+        return f"/previews/{content_hash}/{size}.{self.image_format}"
+
+    async def get_thumbnail(self, content_hash: str, size: str) -> str | None:
+        """Возвращает путь к миниатюре, при первом запросе рендерит ее. None – если исходника нет или рендер упал"""
+
+        path = self.thumbnail_path(content_hash, size)
+        if os.path.exists(path):
+            return path
+
+        # Одновременные запросы одной миниатюры ждут один рендер
+        key = (content_hash, size)
+        task = self._rendering.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._render_thumbnail(content_hash, size))
+            self._rendering[key] = task
+            task.add_done_callback(lambda _: self._rendering.pop(key, None))
+
+        return await asyncio.shield(task)
+
+    async def _render_thumbnail(self, content_hash: str, size: str) -> str | None:
+        source_path = self.source_path(content_hash)
+        if not os.path.exists(source_path):
+            logger.warning(f"Превью: Нет исходника {content_hash}")
+            return None
+
+        image: bytes | None = await self.renderer.render(source_path, self.sizes[size])
+        if image is None:
+            return None
+
+        os.makedirs(self.thumbs_folder, exist_ok=True)
+        path = self.thumbnail_path(content_hash, size)
+        async with aiofiles.open(f"{path}.tmp", "wb") as f:
+            await f.write(image)
+        os.replace(f"{path}.tmp", path)
+
+        logger.info(f"Превью: {size} для {content_hash[:12]} готово, {len(image) // 1024} кб")
+        return path
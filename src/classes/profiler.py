@@ -0,0 +1,81 @@
+import asyncio
+import os
+import sys
+import sysconfig
+import threading
+from collections import Counter
+from types import FrameType
+
+WAITING_FRAME = "(await)"  # Запрос ждет ответа апстрима или своей очереди в event loop
+STDLIB_PATH = sysconfig.get_paths()["stdlib"]
+
+
+def _frame_name(frame: FrameType) -> str:
+    code = frame.f_code
+    path = code.co_filename
+    if path.startswith(os.getcwd()):
+        path = os.path.relpath(path)
+    elif "site-packages" in path:
+        path = path.split("site-packages" + os.sep, 1)[1]
+    elif path.startswith(STDLIB_PATH):
+        path = os.path.relpath(path, STDLIB_PATH)
+    # ; разделяет кадры в collapsed-формате, в именах его быть не должно
+    return f"{code.co_name} ({path}:{code.co_firstlineno})".replace(";", ",")
+
+
+class SamplingProfiler:
+    """
+    Семплирующий профайлер одного запроса. Отдельный поток раз в interval смотрит, что делает event loop:
+    если выполняется задача запроса – берет стек потока, если задача ждет – цепочку ее await до места ожидания.
+    Результат в collapsed-формате (кадр;кадр;кадр число), его понимают flamegraph.pl и speedscope.
+    """
+
+    def __init__(self, interval: float = 0.001):
+        self.interval: float = interval
+        self._stacks: Counter[str] = Counter()
+        self._stop = threading.Event()
+        self._thread: threading.Thread | None = None
+        self._switch_interval: float = sys.getswitchinterval()
+
+    def start(self, task: asyncio.Task):
+        self._task = task
+        self._loop = task.get_loop()
+        self._thread_id = threading.get_ident()
+
+        # Поток профайлера получает GIL не чаще switch interval, без этого семплы шли бы раз в 5 мс
+        sys.setswitchinterval(min(self._switch_interval, self.interval))
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> str:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        sys.setswitchinterval(self._switch_interval)
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self._stacks.items()))
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            stack = self._sample()
+            if stack:
+                self._stacks[";".join(stack)] += 1
+
+    def _sample(self) -> list[str]:
+        if asyncio.current_task(self._loop) is self._task:
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame))
+                frame = frame.f_back
+            return stack[::-1]
+
+        # Задача запроса приостановлена: идем по цепочке корутин до той, что ждет future
+        stack = []
+        coroutine = self._task.get_coro()
+        while coroutine is not None:
+            frame = getattr(coroutine, "cr_frame", None) or getattr(coroutine, "gi_frame", None)
+            if frame is None:
+                break
+            stack.append(_frame_name(frame))
+            coroutine = getattr(coroutine, "cr_await", None) or getattr(coroutine, "gi_yieldfrom", None)
+        return stack + [WAITING_FRAME]
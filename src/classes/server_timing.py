@@ -0,0 +1,50 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar, Token
+
+# Отрезки времени текущего запроса: (имя, секунды). Вне запроса – None, и отрезки никуда не пишутся
+_spans: ContextVar[list[tuple[str, float]] | None] = ContextVar("server_timing_spans", default=None)
+
+
+def activate() -> tuple[list[tuple[str, float]], Token]:
+    """Начинает сбор отрезков для запроса, вызывается в middleware"""
+    spans: list[tuple[str, float]] = []
+    return spans, _spans.set(spans)
+
+
+def deactivate(token: Token):
+    _spans.reset(token)
+
+
+def record(name: str, seconds: float):
+    spans = _spans.get()
+    if spans is not None:
+        spans.append((name, seconds))
+
+
+@contextmanager
+def span(name: str):
+    """Замеряет фазу обработки запроса, она попадет в заголовок Server-Timing"""
+    started_at = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started_at)
+
+
+def header_value(spans: list[tuple[str, float]], total: float) -> str:
+    """Отрезки с одним именем (например, несколько запросов к kommo) складываются в один"""
+
+    merged: dict[str, tuple[float, int]] = {}
+    for name, seconds in spans:
+        duration, calls = merged.get(name, (0.0, 0))
+        merged[name] = (duration + seconds, calls + 1)
+
+    parts = []
+    for name, (duration, calls) in merged.items():
+        part = f"{name};dur={duration * 1000:.1f}"
+        if calls > 1:
+            part += f';desc="x{calls}"'
+        parts.append(part)
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
@@ -0,0 +1,162 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+import brotli
+from loguru import logger
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+
+MANIFEST_NAME = "manifest.json"
+
+# Картинки и шрифты уже сжаты, повторное сжатие только тратит место
+COMPRESSIBLE_EXTENSIONS = {".js", ".css", ".svg", ".html", ".json", ".txt", ".map", ".xml"}
+MIN_COMPRESS_SIZE = 1024
+
+# Порядок – предпочтение, если клиент одинаково принимает оба варианта
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+REVALIDATE_CACHE = "no-cache"
+
+
+def _write_compressed(path: str):
+    with open(path, "rb") as f:
+        data = f.read()
+
+    variants = {
+        ".gz": gzip.compress(data, compresslevel=9, mtime=0),
+        ".br": brotli.compress(data, quality=11),
+    }
+
+    for suffix, compressed in variants.items():
+        if len(compressed) < len(data):
+            with open(path + suffix, "wb") as f:
+                f.write(compressed)
+
+
+def build_assets(source_folder: str, output_folder: str) -> dict[str, dict[str, str]]:
+    """
+    Собирает статику для продакшена: копирует файлы под исходными и хешированными именами
+    (tailwind_browser.js -> tailwind_browser.3f9a1c2b7d10.js), рядом кладет .gz и .br,
+    а соответствие имен записывает в manifest.json. Запускается при деплое: python build_assets.py
+    """
+
+    if os.path.isdir(output_folder):
+        shutil.rmtree(output_folder)
+
+    manifest: dict[str, dict[str, str]] = {}
+    for folder, _, files in os.walk(source_folder):
+        for file_name in sorted(files):
+            source_path = os.path.join(folder, file_name)
+            name = os.path.relpath(source_path, source_folder).replace(os.sep, "/")
+
+            with open(source_path, "rb") as f:
+                digest = hashlib.sha256(f.read()).hexdigest()[:12]
+            stem, extension = os.path.splitext(name)
+            hashed_name = f"{stem}.{digest}{extension}"
+
+            for target_name in (name, hashed_name):
+                target_path = os.path.join(output_folder, target_name)
+                os.makedirs(os.path.dirname(target_path), exist_ok=True)
+                shutil.copyfile(source_path, target_path)
+                if extension in COMPRESSIBLE_EXTENSIONS and os.path.getsize(source_path) >= MIN_COMPRESS_SIZE:
+                    _write_compressed(target_path)
+
+            manifest[name] = {"file": hashed_name, "hash": digest}
+
+    with open(os.path.join(output_folder, MANIFEST_NAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+class AssetManifest:
+    """
+    Хешированные имена собранной статики. В шаблонах: {{ asset_url('tailwind_browser.js') }}.
+    Если статика не собрана (разработка), отдает обычные адреса /static/...
+    """
+
+    def __init__(self, build_folder: str, url_prefix: str = "/static"):
+        self.build_folder: str = build_folder
+        self.url_prefix: str = url_prefix
+        self.entries: dict[str, dict[str, str]] = {}
+
+        try:
+            with open(os.path.join(build_folder, MANIFEST_NAME), encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            logger.info("Статика: Сборка не найдена, раздаем static/ без хешей в именах")
+
+        # Хеш содержимого по любому имени файла – из него ETag; хешированные имена можно кешировать навсегда
+        self.hashes: dict[str, str] = {}
+        self.immutable: set[str] = set()
+        for name, entry in self.entries.items():
+            self.hashes[name] = self.hashes[entry["file"]] = entry["hash"]
+            self.immutable.add(entry["file"])
+
+    @property
+    def is_built(self) -> bool:
+        return bool(self.entries)
+
+    def url(self, name: str) -> str:
+        entry = self.entries.get(name)
+        return f"{self.url_prefix}/{entry['file'] if entry else name}"
+
+
+def accepted_encodings(accept_encoding: str) -> set[str]:
+    """Кодировки из Accept-Encoding, кроме явно запрещенных через q=0"""
+    accepted = set()
+    for part in accept_encoding.split(","):
+        encoding, _, params = part.strip().partition(";")
+        quality = params.strip().removeprefix("q=") if params.strip().startswith("q=") else "1"
+        try:
+            if float(quality) > 0:
+                accepted.add(encoding.strip().lower())
+        except ValueError:
+            continue
+    return accepted
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """
+    StaticFiles, который отдает заранее сжатый .br/.gz вариант файла, если клиент его принимает.
+    Файлы с хешем в имени отдаются с immutable-кешем, остальные – с перепроверкой по ETag от содержимого.
+    """
+
+    def __init__(self, *args, manifest: AssetManifest, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.manifest: AssetManifest = manifest
+        self._root: str = os.path.realpath(self.directory)
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        request_headers = Headers(scope=scope)
+        name = os.path.relpath(full_path, self._root).replace(os.sep, "/")
+
+        headers = {"Cache-Control": IMMUTABLE_CACHE if name in self.manifest.immutable else REVALIDATE_CACHE}
+        media_type = mimetypes.guess_type(str(full_path))[0] or "text/plain"
+        path, encoding = str(full_path), None
+
+        if os.path.exists(f"{full_path}.gz") or os.path.exists(f"{full_path}.br"):
+            headers["Vary"] = "Accept-Encoding"
+            accepted = accepted_encodings(request_headers.get("accept-encoding", ""))
+            for candidate, suffix in ENCODINGS:
+                if candidate in accepted and os.path.exists(f"{full_path}{suffix}"):
+                    path, encoding = f"{full_path}{suffix}", candidate
+                    stat_result = os.stat(path)
+                    headers["Content-Encoding"] = encoding
+                    break
+
+        digest = self.manifest.hashes.get(name)
+        if digest is not None:
+            headers["ETag"] = f'"{digest}-{encoding}"' if encoding else f'"{digest}"'
+
+        response = FileResponse(path, status_code=status_code, stat_result=stat_result, media_type=media_type,
+                                headers=headers)
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
@@ -1,47 +1,281 @@
+import asyncio
 import sys
+import time
+from collections import deque
+from dataclasses import dataclass, field
 
 import httpx
 from httpx import AsyncClient, Response
 
+from src.classes.http_transports import HttpTransports, UpstreamConfig
 from src.models.customer import Customer
 from src.models.document import Document
 
 
+@dataclass
+class OutgoingMessage:
+    """Сообщение в очереди чата и все, кто ждет его доставки"""
+    chat_id: int
+    text: str
+    futures: list[asyncio.Future] = field(default_factory=list)
+    attempts: int = 0
+
+
+@dataclass
+class UploadDigest:
+    """Загрузки одного клиента, накопленные за окно дайджеста"""
+    customer: Customer
+    titles: list[str] = field(default_factory=list)
+    futures: list[asyncio.Future] = field(default_factory=list)
+
+
 class TGLogger:
+    """
+    Отправляет сообщения в телеграм из фоновой очереди: запрос никогда не ждет телеграм.
+    Сообщения в один чат уходят не чаще раза в chat_interval секунд, на 429 чат ставится на паузу по retry_after.
+    В режиме дайджеста (digest_window > 0) отчеты о загрузках за окно собираются в одно сообщение.
+    Методы сразу возвращают future, который завершится после доставки – его можно ждать, а можно нет.
+    """
 
-    def __init__(self, token: str, chat_id: int):
+    # Имя апстрима в HttpTransports
+    UPSTREAM = "telegram"
+
+    def __init__(self, token: str, chat_id: int, chat_interval: float = 3.0, digest_window: float = 0,
+                 max_size: int = 500, max_retries: int = 3, transports: HttpTransports | None = None):
         self.token: str = token
         self.chat_id: int = chat_id
-        self.client: AsyncClient = httpx.AsyncClient(timeout=15.0)
+        self.transports: HttpTransports = transports or HttpTransports({self.UPSTREAM: UpstreamConfig()})
         self.url: str = f"https://api.telegram.org/bot{self.token}/sendMessage"
 
-    async def send_message(self, message: str):
-        """Sends a message to a Telegram chat using the Bot API."""
+        self.chat_interval: float = chat_interval  # В группу телеграм пускает около 20 сообщений в минуту
+        self.digest_window: float = digest_window
+        self.max_size: int = max_size
+        self.max_retries: int = max_retries
+
+        self._queues: dict[int, deque[OutgoingMessage]] = {}
+        self._ready_at: dict[int, float] = {}  # Раньше этого момента в чат не пишем
+        self._has_messages = asyncio.Event()
+
+        self._digest: dict[int, UploadDigest] = {}
+        self._digest_timer: asyncio.TimerHandle | None = None
+
+        # Метрики очереди
+        self.sent_total: int = 0
+        self.failed_total: int = 0
+        self.dropped_total: int = 0
+        self.throttled_total: int = 0
+        self.digested_total: int = 0
+
+    @property
+    def client(self) -> AsyncClient:
+        return self.transports.get(self.UPSTREAM)
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    @property
+    def stats(self) -> dict[str, int]:
+        return {
+            "queue_depth": self.queue_depth,
+            "digest_pending": sum(len(digest.titles) for digest in self._digest.values()),
+            "sent_total": self.sent_total,
+            "failed_total": self.failed_total,
+            "dropped_total": self.dropped_total,
+            "throttled_total": self.throttled_total,
+            "digested_total": self.digested_total,
+        }
+
+    def _new_future(self) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        # Ошибку доставки забирают те, кто ждет future, остальным не нужно предупреждение о непрочитанной ошибке
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        return future
+
+    def send_message(self, message: str, chat_id: int | None = None) -> asyncio.Future:
+        """Ставит сообщение в очередь чата (по умолчанию основного)"""
+
+        future = self._new_future()
 
         if not self.token:
             print("🚨Telegram token not configured. Cannot log.", file=sys.stderr)
-            return
-        if not self.chat_id:
+            future.set_result(None)
+            return future
+        chat_id = chat_id or self.chat_id
+        if not chat_id:
             print("🚨Telegram chat ID not set. Cannot log.", file=sys.stderr)
+            future.set_result(None)
+            return future
+
+        self._put(OutgoingMessage(chat_id=int(chat_id), text=message, futures=[future]))
+        return future
+
+    def send_upload_report(self, document: Document, customer: Customer) -> asyncio.Future:
+
+        if self.digest_window <= 0:
+            return self.send_message(self._upload_report_text(customer, [document.title]))
+
+        future = self._new_future()
+        digest = self._digest.setdefault(customer.amo_id, UploadDigest(customer=customer))
+        digest.customer = customer  # Счетчики документов берем из последнего отчета
+        digest.titles.append(document.title)
+        digest.futures.append(future)
+        self.digested_total += 1
+
+        if self._digest_timer is None:
+            self._digest_timer = asyncio.get_running_loop().call_later(self.digest_window, self._flush_digest)
+        return future
+
+    @staticmethod
+    def _upload_report_text(customer: Customer, titles: list[str]) -> str:
+        message = f"Клиент [{customer.full_name}](https://xeniaceo.kommo.com/leads/detail/{customer.amo_id}) \n"
+        if len(titles) == 1:
+            message += f"Загрузил(а) документ {titles[0]}. \n"
+        else:
+            message += f"Загрузил(а) документы: {', '.join(titles)}. \n"
+        message += f"Всего загружено {customer.docs_stats.get("uploaded")} из {customer.docs_stats.get("total")} документов."
+        return message
+
+    def _flush_digest(self):
+        """Собирает накопленные за окно отчеты в одно сообщение"""
+        self._digest_timer = None
+        digests, self._digest = list(self._digest.values()), {}
+        if not digests:
+            return
+
+        if len(digests) == 1:
+            text = self._upload_report_text(digests[0].customer, digests[0].titles)
+        else:
+            total = sum(len(digest.titles) for digest in digests)
+            minutes = max(1, round(self.digest_window / 60))
+            text = f"{total} загрузок за последние {minutes} мин. \n\n"
+            text += "\n\n".join(self._upload_report_text(digest.customer, digest.titles) for digest in digests)
+
+        delivered = self.send_message(text)
+        futures = [future for digest in digests for future in digest.futures]
+        delivered.add_done_callback(lambda done: self._resolve(futures, done))
+
+    @staticmethod
+    def _resolve(futures: list[asyncio.Future], done: asyncio.Future):
+        """Переносит итог доставки дайджеста на future отдельных отчетов"""
+        error = asyncio.CancelledError() if done.cancelled() else done.exception()
+        for future in futures:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(done.result())
+
+    # ОЧЕРЕДЬ
+
+    def _put(self, message: OutgoingMessage, first: bool = False):
+        queue = self._queues.setdefault(message.chat_id, deque())
+        if first:
+            queue.appendleft(message)
+        elif len(queue) >= self.max_size:
+            self.dropped_total += 1
+            print(f"🚨TG queue for chat {message.chat_id} is full. Cannot log.", file=sys.stderr)
+            for future in message.futures:
+                future.set_exception(asyncio.QueueFull())
             return
+        else:
+            queue.append(message)
+        self._has_messages.set()
+
+    async def drain(self, timeout: float):
+        """Отправляет дайджест и ждет опустения очереди, но не дольше timeout – вызывается при остановке приложения"""
+        if self._digest_timer is not None:
+            self._digest_timer.cancel()
+            self._flush_digest()
+
+        deadline = time.monotonic() + timeout
+        while self.queue_depth and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if self.queue_depth:
+            print(f"🚨TG: {self.queue_depth} messages were not sent before shutdown", file=sys.stderr)
+
+    def _next_chat(self) -> tuple[int | None, float]:
+        """Чат, в который можно написать раньше всех, и сколько до этого ждать"""
+        now = time.monotonic()
+        ready = [(self._ready_at.get(chat_id, 0), chat_id) for chat_id, queue in self._queues.items() if queue]
+        if not ready:
+            return None, 0
+        ready_at, chat_id = min(ready)
+        return chat_id, max(0.0, ready_at - now)
+
+    async def run(self):
+        """Фоновая отправка очереди, запускается в lifespan"""
+        while True:
+            await self._has_messages.wait()
+            chat_id, delay = self._next_chat()
+            if chat_id is None:
+                self._has_messages.clear()
+                continue
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+
+            message = self._queues[chat_id].popleft()
+            try:
+                await self._send(message)
+            except Exception as error:
+                # Неожиданная ошибка не должна останавливать отправку: проваливаем только это сообщение
+                print(f"🚨TG API Error. Cannot log. {error!r}", file=sys.stderr)
+                self._fail(message, repr(error))
+
+    async def _send(self, message: OutgoingMessage):
+        """Sends a message to a Telegram chat using the Bot API."""
 
         payload = {
-            "chat_id": int(self.chat_id),
-            "text": message,
+            "chat_id": message.chat_id,
+            "text": message.text,
             "parse_mode": "Markdown"  # Optional: Use HTML for basic formatting like bold, italics
         }
+        self._ready_at[message.chat_id] = time.monotonic() + self.chat_interval
+        message.attempts += 1
+
         try:
             response: Response = await self.client.post(self.url, data=payload)
-            if response.status_code != 200:
-                print(f"🚨TG API Error. Cannot log. {response.json()}")
         except httpx.HTTPError as e:
-            print(f"🚨TG API Error. Cannot log.")
+            print(f"🚨TG API Error. Cannot log. {e!r}", file=sys.stderr)
+            self._retry(message, delay=self.chat_interval * 2 ** message.attempts)
+            return
 
-    async def send_upload_report(self, document: Document, customer: Customer):
+        if response.status_code == 429:
+            # Телеграм сам говорит, сколько молчать в этот чат
+            self.throttled_total += 1
+            try:
+                retry_after = response.json().get("parameters", {}).get("retry_after", 30)
+            except ValueError:
+                retry_after = 30
+            self._ready_at[message.chat_id] = time.monotonic() + retry_after
+            self._put(message, first=True)
+            return
 
-        message = f"Клиент [{customer.full_name}](https://xeniaceo.kommo.com/leads/detail/{customer.amo_id}) \n"
-        message += f"Загрузил(а) документ {document.title}. \n"
-        message += f"Всего загружено {customer.docs_stats.get("uploaded")} из {customer.docs_stats.get("total")} документов."
+        if response.status_code >= 500:
+            self._retry(message, delay=self.chat_interval * 2 ** message.attempts)
+            return
+
+        if response.status_code != 200:
+            print(f"🚨TG API Error. Cannot log. {response.status_code}: {response.text}", file=sys.stderr)
+            self._fail(message, f"HTTP {response.status_code}")
+            return
+
+        self.sent_total += 1
+        for future in message.futures:
+            if not future.done():
+                future.set_result(True)
+
+    def _retry(self, message: OutgoingMessage, delay: float):
+        if message.attempts > self.max_retries:
+            self._fail(message, "retries exhausted")
+            return
+        self._ready_at[message.chat_id] = time.monotonic() + delay
+        self._put(message, first=True)
 
-        result = await self.send_message(message)
-        return result
+    def _fail(self, message: OutgoingMessage, reason: str):
+        self.failed_total += 1
+        for future in message.futures:
+            if not future.done():
+                future.set_exception(RuntimeError(f"Телеграм не принял сообщение: {reason}"))
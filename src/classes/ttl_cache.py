@@ -0,0 +1,102 @@
+import asyncio
+import time
+from collections import OrderedDict
+from functools import partial
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class TTLCache:
+    """
+    In-process кеш с временем жизни записей, ограниченным размером и вытеснением LRU.
+    Одновременные промахи по одному ключу схлопываются в один запрос (single-flight).
+    """
+
+    def __init__(self, ttl: float, maxsize: int, name: str = "cache"):
+        self.ttl: float = ttl
+        self.maxsize: int = maxsize
+        self.name: str = name
+
+        self._data: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+        self._inflight: dict[Hashable, asyncio.Task] = {}
+
+        self.hits: int = 0
+        self.misses: int = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    @property
+    def stats(self) -> dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits_total": self.hits,
+            "misses_total": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+    def __contains__(self, key: Hashable) -> bool:
+        found, _ = self._lookup(key, count=False)
+        return found
+
+    def _lookup(self, key: Hashable, count: bool = True) -> tuple[bool, Any]:
+        """Ищет живую запись, протухшие записи удаляет по пути"""
+        entry = self._data.get(key)
+
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._data.move_to_end(key)
+                if count:
+                    self.hits += 1
+                return True, value
+            del self._data[key]
+
+        if count:
+            self.misses += 1
+        return False, None
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        found, value = self._lookup(key)
+        return value if found else default
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None):
+        ttl = self.ttl if ttl is None else ttl
+        self._data[key] = (time.monotonic() + ttl, value)
+        self._data.move_to_end(key)
+
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        """Удаляет запись, а результат уже летящего запроса по этому ключу не попадет в кеш"""
+        self._data.pop(key, None)
+        self._inflight.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+        self._inflight.clear()
+
+    async def get_or_fetch(self, key: Hashable, fetch: Callable[[], Awaitable[Any]]) -> Any:
+        """Возвращает значение из кеша, а при промахе загружает его через fetch один раз на всех ожидающих"""
+
+        found, value = self._lookup(key)
+        if found:
+            return value
+
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fetch())
+            self._inflight[key] = task
+            task.add_done_callback(partial(self._on_fetched, key))
+
+        # shield: отмена одного из ожидающих не должна отменять загрузку для остальных
+        return await asyncio.shield(task)
+
+    def _on_fetched(self, key: Hashable, task: asyncio.Task):
+        if self._inflight.get(key) is not task:
+            return  # Запись инвалидировали, пока шел запрос
+        del self._inflight[key]
+
+        if not task.cancelled() and task.exception() is None:
+            self.set(key, task.result())
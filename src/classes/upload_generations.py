@@ -0,0 +1,72 @@
+import asyncio
+import os
+import sqlite3
+import threading
+
+from loguru import logger
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS upload_generations (
+    amo_id INTEGER PRIMARY KEY,
+    generation INTEGER NOT NULL
+);
+"""
+
+
+class UploadGenerations:
+    """
+    Счетчик загрузок каждого клиента в SQLite, общей для всех воркеров uvicorn.
+    Воркер, принявший загрузку, увеличивает счетчик, а остальные по нему понимают,
+    что их закешированный список загрузок клиента устарел.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path: str = db_path
+
+        # Как и в JobQueue: sqlite3 синхронный, ходим в базу из потоков через одно соединение под замком
+        self._connection: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            connection = sqlite3.connect(self.db_path, isolation_level=None, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(SCHEMA)
+            self._connection = connection
+        return self._connection
+
+    def _execute(self, sql: str, params: tuple = ()) -> list[tuple]:
+        with self._lock:
+            return self._connect().execute(sql, params).fetchall()
+
+    async def _query(self, sql: str, params: tuple = ()) -> list[tuple]:
+        return await asyncio.to_thread(self._execute, sql, params)
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None:
+                self._connection.close()
+                self._connection = None
+
+    async def get(self, amo_id: int) -> int | None:
+        """Текущее поколение загрузок клиента. None – если база недоступна и кешу верить нельзя"""
+        try:
+            rows = await self._query("SELECT generation FROM upload_generations WHERE amo_id = ?", (amo_id,))
+        except sqlite3.Error as error:
+            logger.error(f"Загрузки: Не удалось прочитать поколение загрузок {amo_id}: {error!r}")
+            return None
+        return rows[0][0] if rows else 0
+
+    async def bump(self, amo_id: int) -> int | None:
+        """Отмечает новую загрузку клиента и возвращает новое поколение"""
+        try:
+            rows = await self._query(
+                "INSERT INTO upload_generations (amo_id, generation) VALUES (?, 1) "
+                "ON CONFLICT (amo_id) DO UPDATE SET generation = generation + 1 RETURNING generation",
+                (amo_id,),
+            )
+        except sqlite3.Error as error:
+            logger.error(f"Загрузки: Не удалось отметить загрузку {amo_id}: {error!r}")
+            return None
+        return rows[0][0]
@@ -3,13 +3,23 @@ from http.client import HTTPException
 
 import httpx
 
+from src.classes.http_transports import HttpTransports, UpstreamConfig
+
 ALBATO_NOTE_WEBHOOK = "https://h.albato.ru/wh/38/1lfhppn/t1musdxlKThqewpqzrQq6y0dvj8-e3RZjbnYClo6qIw/"
 ALBATO_TASK_WEBHOOK = "https://h.albato.ru/wh/38/1lfhppn/ncgbtSUJHBZQLY4mAwBnLzwlLfPqwT_BWrEzj8fiS3k/"
 
 class WebhookPusher:
 
-    def __init__(self):
-        self.client = httpx.AsyncClient(timeout=5.0)
+    # Имя апстрима в HttpTransports
+    UPSTREAM = "albato"
+
+    def __init__(self, transports: HttpTransports | None = None):
+        self.transports: HttpTransports = transports or HttpTransports(
+            {self.UPSTREAM: UpstreamConfig(read_timeout=5.0, write_timeout=5.0)})
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        return self.transports.get(self.UPSTREAM)
 
     async def add_note(self, lead_id, message, JSON=None):
 
@@ -1,20 +1,80 @@
 # Настраиваем шаблоны
+import os
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
 from starlette.templating import Jinja2Templates
 
-from config import TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, AMO_REPORT_URL
+from config import TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, TELEGRAM_CHAT_INTERVAL, TELEGRAM_DIGEST_WINDOW, \
+    AMO_REPORT_URL, AMO_REPORT_QUEUE_SIZE, AMO_REPORT_BATCH_SIZE, AMO_REPORT_MAX_RETRIES, amo_api, PREVIEW_WORKERS, \
+    PREVIEW_PAGE, PREVIEW_TIMEOUT, PREVIEW_SIZES, PREVIEW_FORMAT, PREVIEW_QUALITY, PREVIEWS_FOLDER, JOBS_DB_PATH, \
+    JOB_MAX_ATTEMPTS, JOB_LEASE, http_transports, metrics, FRAGMENT_CACHE_TTL, FRAGMENT_CACHE_SIZE, TEMPLATES_FOLDER, \
+    TEMPLATES_AUTO_RELOAD, TEMPLATES_BYTECODE_FOLDER, STATIC_BUILD_FOLDER, UPLOADS_DB_PATH
 from src.classes.amo.amo_reporter import AmoReporter
 from src.classes.doc_manager import DocManager
+from src.classes.fragment_cache import FragmentCache, folder_fingerprint, version_of
 from src.classes.gas.gas_api import GDriveFetcher
+from src.classes.job_queue import JobQueue
+from src.classes.metrics import timed_template_class
+from src.classes.preview_renderer import PreviewRenderer
+from src.classes.preview_store import PreviewStore
+from src.classes.static_assets import AssetManifest
 from src.classes.tg.tg_logger import TGLogger
-from src.utils import format_datetime_ru, markdown_to_html
+from src.classes.upload_generations import UploadGenerations
+from src.utils import format_datetime_ru, markdown_to_html, markdown_cache_stats
+
+
+class LazyBytecodeCache(FileSystemBytecodeCache):
+    """Байткод шаблонов на диске. Папка создается при первой записи, а не при импорте модуля"""
+
+    def dump_bytecode(self, bucket):
+        os.makedirs(self.directory, exist_ok=True)
+        super().dump_bytecode(bucket)
+
 
-templates = Jinja2Templates(directory="src/templates")
+# Вне разработки шаблоны не перечитываются с диска, а скомпилированный байткод переживает перезапуск
+templates = Jinja2Templates(env=Environment(
+    loader=FileSystemLoader(TEMPLATES_FOLDER),
+    autoescape=True,
+    auto_reload=TEMPLATES_AUTO_RELOAD,
+    bytecode_cache=LazyBytecodeCache(TEMPLATES_BYTECODE_FOLDER),
+))
+templates.env.template_class = timed_template_class(
+    metrics.histogram("template_render_duration_seconds", "Время рендера шаблона", ("template",)))
 templates.env.filters["rudate"] = format_datetime_ru
 templates.env.filters['markdown'] = markdown_to_html
 
+# Адреса статики с хешем содержимого, если она собрана
+asset_manifest = AssetManifest(STATIC_BUILD_FOLDER)
+templates.env.globals["asset_url"] = asset_manifest.url
+
+# Готовые секции страниц, см. FragmentCache. Страницы зависят от шаблонов и от адресов собранной статики
+fragment_cache = FragmentCache(FRAGMENT_CACHE_TTL, FRAGMENT_CACHE_SIZE,
+                               generation=version_of(folder_fingerprint(TEMPLATES_FOLDER), asset_manifest.entries))
+templates.env.globals["fragment"] = fragment_cache.render
+
 # Создаем адаптеры для гугл-доков
-gas_api = GDriveFetcher()
-gd_pusher = DocManager()
-amo_reporter = AmoReporter(AMO_REPORT_URL)
+upload_generations = UploadGenerations(UPLOADS_DB_PATH)
+gas_api = GDriveFetcher(transports=http_transports, upload_generations=upload_generations)
+preview_renderer = PreviewRenderer(PREVIEW_WORKERS, PREVIEW_PAGE, PREVIEW_TIMEOUT, PREVIEW_FORMAT, PREVIEW_QUALITY)
+preview_store = PreviewStore(PREVIEWS_FOLDER, preview_renderer, PREVIEW_SIZES, PREVIEW_FORMAT)
+gd_pusher = DocManager(on_upload=gas_api.add_upload, previews=preview_store, transports=http_transports)
+templates.env.filters["preview_url"] = preview_store.url_for
+amo_reporter = AmoReporter(AMO_REPORT_URL, on_write=amo_api.invalidate, max_size=AMO_REPORT_QUEUE_SIZE,
+                           batch_size=AMO_REPORT_BATCH_SIZE, max_retries=AMO_REPORT_MAX_RETRIES,
+                           transports=http_transports)
+
+tg_logger: TGLogger = TGLogger(TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID, chat_interval=TELEGRAM_CHAT_INTERVAL,
+                               digest_window=TELEGRAM_DIGEST_WINDOW, transports=http_transports)
+
+# Очередь фоновых задач, обработчики регистрируются в src/jobs.py
+job_queue = JobQueue(JOBS_DB_PATH, max_attempts=JOB_MAX_ATTEMPTS, lease=JOB_LEASE)
 
-tg_logger: TGLogger = TGLogger(TELEGRAM_BOT_TOKEN, TELEGRAM_CHAT_ID)
+# Состояние очередей, кешей и лимитера снимается в момент запроса /metrics
+metrics.add_collector("kommo_limiter", lambda: amo_api.limiter.stats)
+metrics.add_collector("amo_reporter", lambda: amo_reporter.stats)
+metrics.add_collector("telegram", lambda: tg_logger.stats)
+metrics.add_collector("jobs", job_queue.stats)
+for cache in (amo_api.lead_cache, amo_api.contact_cache, amo_api.lead_contacts, gas_api.uploads, fragment_cache.cache,
+              preview_store.links):
+    metrics.add_collector("cache", lambda cache=cache: cache.stats, labels={"cache": cache.name})
+metrics.add_collector("cache", markdown_cache_stats, labels={"cache": "markdown"})
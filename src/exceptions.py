@@ -5,3 +5,12 @@ class InsufficientDataError(Exception):
         """Инициализирует исключение InsufficientDataError."""
         self.message = message
         super().__init__(self.message)  #Вызов конструктора базового класса
+
+
+class UpstreamUnavailableError(Exception):
+    """Исключение, когда внешний сервис (Kommo, Apps Script) временно не отвечает или ограничивает запросы."""
+
+    def __init__(self, message="Сервис временно перегружен, попробуйте обновить страницу через минуту"):
+        """Инициализирует исключение UpstreamUnavailableError."""
+        self.message = message
+        super().__init__(self.message)
@@ -0,0 +1,64 @@
+"""Фоновые задачи после загрузки документа: выполняются воркерами JobQueue, а не в запросе /upload"""
+import asyncio
+from typing import Any
+
+from config import amo_api, JOB_DELIVERY_TIMEOUT
+from src.classes.amo.rate_limiter import Priority
+from src.classes.job_queue import JobQueue
+from src.dependencies import gas_api, tg_logger, amo_reporter
+from src.models.customer import Customer
+from src.models.document import Document
+
+UPLOAD_TG_REPORT_JOB = "upload_tg_report"
+UPLOAD_AMO_REPORT_JOB = "upload_amo_report"
+
+
+async def _load_uploaded_document(amo_id: int, doc_id: int | str) -> tuple[Customer, Document]:
+    """Собирает клиента с актуальными загрузками и документ, который он загрузил"""
+
+    customer: Customer = await amo_api.fetch_lead_data(amo_id, priority=Priority.BACKGROUND)
+    customer.specialty = gas_api.get_specialty(customer.specialty_id)
+    customer.docs = gas_api.get_documents_by_indices(customer.specialty.docs_required, customer.docs_ready)
+    customer.set_uploads(await gas_api.get_all_uploads(amo_id))
+
+    if str(doc_id).isalpha():
+        document: Document = customer.docs_extra.get(doc_id)
+    else:
+        document: Document = customer.docs.get(int(doc_id)) or gas_api.get_document(int(doc_id))
+
+    return customer, document
+
+
+async def send_upload_tg_report(payload: dict[str, Any]):
+    customer, document = await _load_uploaded_document(payload["amo_id"], payload["doc_id"])
+    delivered = tg_logger.send_upload_report(document, customer)
+
+    # В режиме дайджеста отчет уходит только в конце окна: задача выполнена, как только он попал в дайджест,
+    # иначе каждая загрузка держала бы воркер до конца окна
+    if tg_logger.digest_window > 0:
+        return
+
+    # Без дайджеста ждем доставки, но не дольше JOB_DELIVERY_TIMEOUT, дальше попытка провалится и повторится
+    try:
+        await asyncio.wait_for(delivered, timeout=JOB_DELIVERY_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise RuntimeError(f"Телеграм не подтвердил доставку за {JOB_DELIVERY_TIMEOUT:.0f} с")
+
+
+async def send_upload_amo_report(payload: dict[str, Any]):
+    customer, document = await _load_uploaded_document(payload["amo_id"], payload["doc_id"])
+    # Ставим оба события в очередь АМО сразу, чтобы они могли уйти одной пачкой, и ждем доставки.
+    # Не дольше JOB_DELIVERY_TIMEOUT: зависшая очередь не должна держать воркер, попытка провалится и повторится
+    delivered = asyncio.gather(
+        amo_reporter.update_documents(customer.amo_id, [doc.doc_id for doc in customer.docs.values() if doc.is_uploaded]),
+        amo_reporter.add_comment(customer.amo_id, f"Документ {document.title} загружен"),
+    )
+    try:
+        await asyncio.wait_for(delivered, timeout=JOB_DELIVERY_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise RuntimeError(f"АМО не подтвердил доставку за {JOB_DELIVERY_TIMEOUT:.0f} с")
+
+
+def register_jobs(queue: JobQueue):
+    queue.register(UPLOAD_TG_REPORT_JOB, send_upload_tg_report)
+    queue.register(UPLOAD_AMO_REPORT_JOB, send_upload_amo_report)
@@ -0,0 +1,129 @@
+import asyncio
+import hmac
+import time
+from urllib.parse import parse_qs
+
+from starlette.datastructures import MutableHeaders
+from starlette.responses import Response
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from src.classes import server_timing
+from src.classes.metrics import MetricsRegistry
+from src.classes.profiler import SamplingProfiler
+
+
+class MetricsMiddleware:
+    """
+    Пишет в метрики время обработки каждого запроса до отправки ответа целиком.
+    Путь берется шаблоном маршрута (/profile/{amo_id}), а не фактическим адресом, чтобы не плодить метки.
+    """
+
+    def __init__(self, app: ASGIApp, registry: MetricsRegistry):
+        self.app: ASGIApp = app
+        self.duration = registry.histogram("http_server_request_duration_seconds",
+                                           "Время обработки запроса к приложению", ("method", "route", "status"))
+        self.in_flight = registry.gauge("http_server_requests_in_flight", "Запросы к приложению в обработке")
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = "500"
+
+        async def send_with_status(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = str(message["status"])
+            await send(message)
+
+        self.in_flight.inc()
+        started_at = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            self.in_flight.dec()
+            self.duration.observe(time.perf_counter() - started_at, method=scope["method"],
+                                  route=self._route(scope), status=status)
+
+    @staticmethod
+    def _route(scope: Scope) -> str:
+        route = scope.get("route")
+        if route is not None:
+            return route.path
+        # Смонтированные папки (/static, /uploads) маршрута не имеют, берем префикс монтирования
+        return scope.get("root_path") or "unmatched"
+
+
+class ServerTimingMiddleware:
+    """
+    Добавляет к ответу заголовок Server-Timing с фазами запроса: вызовы апстримов, рендер шаблона
+    и отрезки, отмеченные в обработчиках через server_timing.span. Видно во вкладке Network браузера.
+
+    С ?profile=1 и админским токеном (заголовок X-Admin-Token или параметр admin_token) вместо ответа
+    отдает семплирующий профиль этого запроса в collapsed-формате для flamegraph.
+    """
+
+    def __init__(self, app: ASGIApp, admin_token: str | None = None, profile_interval: float = 0.001):
+        self.app: ASGIApp = app
+        self.admin_token: str | None = admin_token
+        self.profile_interval: float = profile_interval
+
+        # Профайлер меняет switch interval всего процесса, поэтому профилируем по одному запросу
+        self._profile_lock = asyncio.Lock()
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        spans, token = server_timing.activate()
+        started_at = time.perf_counter()
+
+        async def send_with_timing(message: Message):
+            if message["type"] == "http.response.start":
+                headers = MutableHeaders(scope=message)
+                headers.append("Server-Timing", server_timing.header_value(spans, time.perf_counter() - started_at))
+            await send(message)
+
+        try:
+            if self._wants_profile(scope):
+                await self._profile(scope, receive, send_with_timing)
+            else:
+                await self.app(scope, receive, send_with_timing)
+        finally:
+            server_timing.deactivate(token)
+
+    def _wants_profile(self, scope: Scope) -> bool:
+        if not self.admin_token:
+            return False
+        query = parse_qs(scope.get("query_string", b"").decode("latin-1"))
+        if query.get("profile") != ["1"]:
+            return False
+
+        headers = dict(scope["headers"])
+        given = headers.get(b"x-admin-token", b"").decode("latin-1") or query.get("admin_token", [""])[0]
+        return hmac.compare_digest(given.encode(), self.admin_token.encode())
+
+    async def _profile(self, scope: Scope, receive: Receive, send: Send):
+        status = 500
+
+        async def discard(message: Message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+
+        async with self._profile_lock:
+            profiler = SamplingProfiler(self.profile_interval)
+            profiler.start(asyncio.current_task())
+            try:
+                await self.app(scope, receive, discard)
+            finally:
+                folded = profiler.stop()
+
+        response = Response(folded, media_type="text/plain; charset=utf-8", headers={
+            "Content-Disposition": 'attachment; filename="profile.folded"',
+            "Cache-Control": "no-store",
+            "X-Profiled-Status": str(status),
+        })
+        await response(scope, receive, send)
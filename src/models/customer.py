@@ -44,7 +44,7 @@ class Customer(BaseModel):
     docs: dict[int, Document] = Field(default_factory=dict, description="Обработанный список документов")
     uploads: dict[str | int, UploadedDocument] = Field(default_factory=dict, description="Хранилище всех загруженных документов")
 
-    faq: list[FAQ] = Field(default_factory=list, description="Список FAQ доступный пользователю")
+    faq: tuple[FAQ, ...] = Field(default=(), description="Список FAQ доступный пользователю")
 
     group_id: str = Field(default=None, description="Указатель на группу")
     group: Optional[Group] = Field(default=None, description="Объект группы с куратором, преподом и экспертом")
@@ -63,18 +63,23 @@ class Customer(BaseModel):
     has_full_support: bool = Field(default=False, description="Оплачено ли сопровождение (влияет на отображение блоков)")
 
     def set_uploads(self, uploads: list[UploadedDocument]):
-        """Sets uploaded status info for basic and extra uploads"""
+        """
+        Sets uploaded status info for basic and extra uploads.
+        Документы каталога общие для всех клиентов, поэтому вместо изменения кладем в клиента их копии.
+        """
 
+        grouped: dict[tuple[bool, str | int], list[UploadedDocument]] = {}
         for upload in uploads:
+            grouped.setdefault((upload.is_extra, upload.doc_id), []).append(upload)
 
-            if upload.is_extra:  # Если дополнительный документ
-                doc = self.docs_extra.get(upload.doc_id)
-            else:  # Если обычный документ
-                doc = self.docs.get(upload.doc_id)
+        for (is_extra, doc_id), doc_uploads in grouped.items():
+
+            # Если дополнительный документ – ищем среди них, иначе среди обычных
+            target: dict = self.docs_extra if is_extra else self.docs
+            doc = target.get(doc_id)
 
             if doc is not None:
-                doc.is_uploaded = True
-                doc.uploads.append(upload)
+                target[doc_id] = doc.model_copy(update={"is_uploaded": True, "uploads": doc.uploads + tuple(doc_uploads)})
 
     @property
     def docs_stats(self) -> DocStatsDict:
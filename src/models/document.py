@@ -1,6 +1,6 @@
 from datetime import datetime
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class UploadedDocument(BaseModel):
@@ -14,14 +14,28 @@ class UploadedDocument(BaseModel):
     picture_url: str = Field(default=None, description="Picture URL of the document")
 
 
+class UploadResult(BaseModel):
+    """Итог загрузки одного файла из формы: загруженный документ либо текст ошибки"""
+    filename: str = Field(...)
+    document: UploadedDocument | None = Field(default=None)
+    error: str | None = Field(default=None)
+
+    @property
+    def is_ok(self) -> bool:
+        return self.error is None
+
+
 class Document(BaseModel):
+    """Документ из каталога. Неизменяемый: статус загрузки клиента накладывается копией, см. Customer.set_uploads"""
+
+    model_config = ConfigDict(frozen=True)
 
     id: int = Field(..., description="Unique identifier")
     title: str = Field(..., min_length=1, max_length=255, description="Title of the document")
     description: str = Field(..., description="Brief description of the document")
     guide: str = Field(default="", description="Detailed guide how to get the document")
 
-    uploads: list[UploadedDocument] = Field(default_factory=list)
+    uploads: tuple[UploadedDocument, ...] = Field(default=())
 
     is_extra: bool = Field(default=False, description="Is Document assigned manually, having name, not ID")
     is_uploaded: bool = Field(default=False, description="Whether the document was uploaded")
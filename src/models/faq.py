@@ -1,6 +1,8 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class FAQ(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     question: str
     answer: str
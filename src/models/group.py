@@ -1,13 +1,17 @@
 import zoneinfo
+from bisect import bisect_right
 from datetime import datetime, timedelta, timezone
 from typing import Optional
 
-from pydantic import BaseModel, Field, field_validator
+from pydantic import BaseModel, ConfigDict, Field, PrivateAttr, field_validator
 
 TIMEZONE = zoneinfo.ZoneInfo("Asia/Qatar")
+NO_DATE = datetime.min.replace(tzinfo=timezone.utc)
 
 
 class Person(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     name: str = Field(..., description="Group Name")
     role: str = Field(default="", description="Role, eg curator, teacher, expert")
     avatar: str = Field(default="", description="Person photo url")
@@ -16,6 +20,8 @@ class Person(BaseModel):
 
 
 class GroupEvent(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     title: str = Field(..., description="Event Name")
     description: str = Field(default="", description="Event description")
     link: str = Field(default="", description="Event link")
@@ -29,23 +35,32 @@ class GroupEvent(BaseModel):
 
 
 class Group(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     id: str = Field(..., description="Group ID as in Calendar")
     chat_tg: str = Field(default="", description="Group chat link")
     curator: Optional[Person] = Field(..., description="Group Curator")
     teacher: Optional[Person] = Field(..., description="Group Teacher")
     expert: Optional[Person] = Field(..., description="Group Expert")
-    events: list[GroupEvent] = Field(default_factory=list, description="Group Events")
+    events: tuple[GroupEvent, ...] = Field(default=(), description="Group Events, sorted by start")
 
-    @property
-    def events_upcoming_3(self):
+    # Отсортированные даты начала событий, индекс для бинарного поиска ближайших
+    _events_starts: tuple[datetime, ...] = PrivateAttr(default=())
 
-        now = datetime.now(timezone.utc)
-        three_hours_ago = now - timedelta(hours=3)
-        upcoming = []
+    @field_validator('events', mode='after')
+    def sort_events(cls, events: tuple[GroupEvent, ...]) -> tuple[GroupEvent, ...]:
+        return tuple(sorted(events, key=lambda event: event.starts or NO_DATE))
 
-        for event in self.events:
-            if event.starts > three_hours_ago:
-                upcoming.append(event)
-                if len(upcoming) >= 3:
-                    break
-        return upcoming
+    def model_post_init(self, context) -> None:
+        self._events_starts = tuple(event.starts or NO_DATE for event in self.events)
+
+    def next_events(self, count: int = 3, now: datetime | None = None) -> tuple[GroupEvent, ...]:
+        """Ближайшие события, включая начавшиеся не больше трех часов назад. O(log n) по числу событий"""
+
+        three_hours_ago = (now or datetime.now(timezone.utc)) - timedelta(hours=3)
+        first = bisect_right(self._events_starts, three_hours_ago)
+        return self.events[first:first + count]
+
+    @property
+    def events_upcoming_3(self):
+        return self.next_events(3)
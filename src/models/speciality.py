@@ -1,10 +1,12 @@
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 from src.models.document import Document
 
 
 class Speciality(BaseModel):
+    model_config = ConfigDict(frozen=True)
+
     id: int
     title: str
-    docs_required: list[int]
+    docs_required: tuple[int, ...]
     description: str
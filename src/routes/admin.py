@@ -1,13 +1,89 @@
-from fastapi import APIRouter
+import asyncio
+import hmac
+
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException
+from loguru import logger
 from starlette.requests import Request
+from starlette.responses import PlainTextResponse
 
-from src.dependencies import gas_api, templates, tg_logger
+from config import amo_api, metrics, OPERATIONAL_FUNNEL_ID, ADMIN_TOKEN
+from src.dependencies import gas_api, templates, tg_logger, amo_reporter
 admin_router = APIRouter()
 
+# Прогрев сделок идет не больше одного за раз
+_warmup_lock = asyncio.Lock()
+
+
+async def require_admin(request: Request):
+    """Пускает только с ADMIN_TOKEN в заголовке X-Admin-Token или параметре admin_token. Без токена в конфиге – никого"""
+    given = request.headers.get("x-admin-token") or request.query_params.get("admin_token", "")
+    if not ADMIN_TOKEN or not hmac.compare_digest(given.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+
+async def refresh_and_report():
+    """Обновляет каталог в фоне и сообщает в телеграм, если получилось"""
+    if await gas_api.refresh():
+        tg_logger.send_message("Данные на сервере обновлены из гугл-диска")
+
 
 @admin_router.get("/refresh")
-async def refresh(request: Request):
-    result = await gas_api.preload()
-    context = {"request": request, "config": gas_api.config}
-    await tg_logger.send_message("Данные на сервере обновлены из гугл-диска")
+async def refresh(request: Request, background_tasks: BackgroundTasks):
+    """Запускает обновление каталога и сразу возвращает его статус, не дожидаясь гугл-таблиц"""
+    is_started = not gas_api.refresh_state.is_running
+    if is_started:
+        background_tasks.add_task(refresh_and_report)
+
+    context = {"request": request, "config": gas_api.config, "state": gas_api.refresh_state, "is_started": is_started}
     return templates.TemplateResponse("admin/refreshed.html", context)
+
+
+async def warm_up_leads():
+    """Загружает все сделки операционной воронки списочными запросами и прогревает кеши сделок и контактов"""
+    if _warmup_lock.locked():
+        return
+
+    async with _warmup_lock:
+        try:
+            customers = await amo_api.fetch_pipeline_leads(OPERATIONAL_FUNNEL_ID)
+        except Exception as error:
+            logger.error(f"Прогрев: Не удалось загрузить сделки воронки: {error!r}")
+            return
+        logger.info(f"Прогрев: Загружено сделок воронки: {len(customers)}")
+
+
+@admin_router.get("/warmup/leads", dependencies=[Depends(require_admin)])
+async def warmup_leads(background_tasks: BackgroundTasks):
+    """
+    Запускает прогрев кешей сделок в фоне. Стоит дернуть перед стартом нового потока,
+    чтобы первые заходы студентов не шли в Kommo по одному
+    """
+    is_started = not _warmup_lock.locked()
+    if is_started:
+        background_tasks.add_task(warm_up_leads)
+
+    return {"is_started": is_started}
+
+
+@admin_router.get("/stats/kommo", dependencies=[Depends(require_admin)])
+async def kommo_stats():
+    """Сколько запросы к Kommo ждали в очереди лимитера и сколько выполнялись"""
+    return amo_api.limiter.stats
+
+
+@admin_router.get("/stats/amo-reporter", dependencies=[Depends(require_admin)])
+async def amo_reporter_stats():
+    """Очередь событий в АМО: глубина, сколько схлопнуто, доставлено и сколько заняли отправки"""
+    return amo_reporter.stats
+
+
+@admin_router.get("/stats/telegram", dependencies=[Depends(require_admin)])
+async def telegram_stats():
+    """Очередь сообщений в телеграм: глубина, отправлено, упало и сколько раз телеграм просил подождать"""
+    return tg_logger.stats
+
+
+@admin_router.get("/metrics", dependencies=[Depends(require_admin)])
+async def prometheus_metrics():
+    """Все метрики приложения в текстовом формате Prometheus"""
+    return PlainTextResponse(await metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -1,6 +1,8 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, HTTPException
 
 from config import amo_api
+from src.classes.job_queue import Job
+from src.dependencies import job_queue
 from src.models.customer import Customer
 
 api_router = APIRouter()
@@ -11,3 +13,14 @@ async def documents(amo_id: int):
     # Загружаем данные из AMO
     customer: Customer = await amo_api.fetch_lead_data(amo_id)
     return customer.model_dump()
+
+
+@api_router.get("/api/jobs/{job_id}")
+async def job_status(job_id: str):
+    """Статус фоновой задачи, например отчета о загрузке: страница с результатом загрузки опрашивает его до завершения"""
+    job: Job | None = await job_queue.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return {"id": job.id, "kind": job.kind, "status": job.status, "attempts": job.attempts,
+            "is_finished": job.is_finished}
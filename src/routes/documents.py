@@ -4,9 +4,10 @@ from loguru import logger
 
 from config import amo_api
 from src.classes.amo.types import ExtraDoc
-from src.dependencies import gas_api, templates, gd_pusher, tg_logger, amo_reporter
+from src.dependencies import gas_api, templates, gd_pusher, job_queue
+from src.jobs import UPLOAD_TG_REPORT_JOB, UPLOAD_AMO_REPORT_JOB
 from src.models.customer import Customer
-from src.models.document import Document, UploadedDocument, ExtraDocument
+from src.models.document import Document, UploadedDocument, ExtraDocument, UploadResult
 
 document_router = APIRouter()
 
@@ -63,29 +64,33 @@ async def upload_document(request: Request, file: UploadFile = File(...), file_2
 
         logger.debug(f"Загрузка: {file.filename} => файл {doc_id} от пользователя {amo_id}")
 
-        files_to_upload = filter(lambda f: f.filename, [file, file_2, file_3])
-        for index, one_file in enumerate(files_to_upload, start=1):
-            logger.debug(f"Загрузка:  Начинаем загрузку файла {index}")
-            result = await gd_pusher.upload_file(one_file, amo_id, doc_id)
+        files_to_upload = [one_file for one_file in (file, file_2, file_3) if one_file.filename]
+        results: list[UploadResult] = await gd_pusher.upload_files(files_to_upload, amo_id, doc_id)
+        is_uploaded = any(result.is_ok for result in results)
+
+        # Сделка в кеше больше не актуальна
+        amo_api.invalidate(amo_id)
 
         customer.specialty = gas_api.get_specialty(customer.specialty_id)
 
         specialty_docs = customer.specialty.docs_required
         customer.docs = gas_api.get_documents_by_indices(specialty_docs, customer.docs_ready)
 
-        # Получаем все загрузки и актуализируем пользователя
+        # Получаем все загрузки (индекс уже дописан при загрузке) и актуализируем пользователя
         all_uploads: list[UploadedDocument] = await gas_api.get_all_uploads(amo_id)
         customer.set_uploads(all_uploads)
 
-        # Получаем док (в зависимости от типа)
-        document: Document = customer.docs_extra.get(doc_id) if doc_is_extra else gas_api.get_document(int(doc_id))
-
-        # Сообщаем в телеграм о завершении загрузки
-        await tg_logger.send_upload_report(document, customer)
+        # Получаем док клиента (в зависимости от типа) вместе с его загрузками
+        if doc_is_extra:
+            document: Document = customer.docs_extra.get(doc_id)
+        else:
+            document: Document = customer.docs.get(int(doc_id)) or gas_api.get_document(int(doc_id))
 
-        # Сообщаем в амо о завершении загрузки
-        amo_reporter.update_documents(amo_id, [doc.doc_id for doc in customer.docs.values() if doc.is_uploaded])
-        amo_reporter.add_comment(amo_id, f"Документ {document.title} загружен")
+        # Сообщаем в телеграм и в амо о завершении загрузки, страница опрашивает статус этих задач
+        report_jobs: list[str] = []
+        if is_uploaded:
+            report_jobs.append(await job_queue.enqueue(UPLOAD_TG_REPORT_JOB, {"amo_id": amo_id, "doc_id": doc_id}))
+            report_jobs.append(await job_queue.enqueue(UPLOAD_AMO_REPORT_JOB, {"amo_id": amo_id, "doc_id": doc_id}))
 
         context = {
             "request": request,
@@ -94,9 +99,12 @@ async def upload_document(request: Request, file: UploadFile = File(...), file_2
             "config": gas_api.config,
             "uploads": document.uploads,
             "doc_is_extra": doc_is_extra,
+            "upload_results": results,
+            "report_jobs": report_jobs,
         }
 
-        return templates.TemplateResponse("pages/document.html", context)
+        status_code = 200 if is_uploaded else 400
+        return templates.TemplateResponse("pages/document.html", context, status_code=status_code)
 
     except ValueError:
         raise HTTPException(status_code=400, detail="amo_id or doc_id incorrect")
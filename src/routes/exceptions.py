@@ -1,7 +1,7 @@
 from starlette.requests import Request
 from config import logger
 from src.dependencies import templates, gas_api
-from src.exceptions import InsufficientDataError
+from src.exceptions import InsufficientDataError, UpstreamUnavailableError
 
 
 async def insufficient_data_exception_handler(request: Request, exc: InsufficientDataError):
@@ -13,6 +13,19 @@ async def insufficient_data_exception_handler(request: Request, exc: Insufficien
     return templates.TemplateResponse("errors/400.html", context, status_code=400)
 
 
+async def upstream_unavailable_exception_handler(request: Request, exc: UpstreamUnavailableError):
+    """Kommo или Apps Script не ответили даже после повторов – просим обновить страницу позже."""
+
+    logger.warning(f"Upstream unavailable for request {request.url}")
+
+    context = {
+        "request": request,
+        "error_message": exc.message,
+        "config": gas_api.config
+    }
+    return templates.TemplateResponse("errors/500.html", context, status_code=503, headers={"Retry-After": "30"})
+
+
 async def generic_exception_handler(request: Request, exc: Exception):
     """Handles any uncaught exception, returning a generic 500 error page."""
 
@@ -0,0 +1,25 @@
+from fastapi import APIRouter, HTTPException
+from starlette.responses import FileResponse
+
+from config import PREVIEW_PLACEHOLDER
+from src.dependencies import preview_store
+
+preview_router = APIRouter()
+
+# Адрес превью содержит хеш файла, поэтому по одному адресу всегда одна и та же картинка
+IMMUTABLE_CACHE = "public, max-age=31536000, immutable"
+
+
+@preview_router.get("/previews/{content_hash}/{size}.{extension}")
+async def preview(content_hash: str, size: str, extension: str):
+    """Миниатюра загруженного PDF: рендерится при первом запросе, дальше отдается с диска"""
+
+    if not preview_store.is_known(content_hash, size, extension):
+        raise HTTPException(status_code=404, detail="Preview not found")
+
+    path: str | None = await preview_store.get_thumbnail(content_hash, size)
+    if path is None:
+        # Заглушку не кешируем: следующий запрос попробует отрендерить превью еще раз
+        return FileResponse(PREVIEW_PLACEHOLDER, headers={"Cache-Control": "no-cache"})
+
+    return FileResponse(path, media_type=preview_store.media_type, headers={"Cache-Control": IMMUTABLE_CACHE})
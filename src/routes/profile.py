@@ -1,19 +1,52 @@
 from fastapi import APIRouter
 from starlette.requests import Request
+from starlette.responses import Response
 
 from config import amo_api
-from src.dependencies import templates, gas_api, amo_reporter
+from src.classes.fragment_cache import version_of, etag_matches
+from src.classes.server_timing import span
+from src.dependencies import templates, gas_api, amo_reporter, fragment_cache
 from src.models.customer import Customer
 from src.models.document import UploadedDocument
 
 profile_router = APIRouter()
 
+# Страница персональная и должна перепроверяться при каждом заходе, но по ETag это почти бесплатно
+PROFILE_CACHE_CONTROL = "private, no-cache"
+
+
+def section_versions(customer: Customer, uploads: list[UploadedDocument], catalog_version: str) -> dict[str, str]:
+    """
+    Версии секций профиля: в каждую входят поля клиента, которые читает шаблон секции,
+    версия каталога и набор загрузок. Если секция начинает выводить новое поле, его нужно добавить сюда
+    """
+
+    upload_set = tuple(sorted(f"{upload.doc_id}:{upload.gdrive_id}" for upload in uploads))
+    # Из моделей берем только выводимые поля: repr целых pydantic-моделей стоил дороже рендера секции
+    docs_extra = tuple((key, doc.title, doc.description, doc.is_uploaded) for key, doc in customer.docs_extra.items())
+    events = tuple((event.starts, event.title) for event in customer.group.events_upcoming_3) if customer.group else ()
+
+    sections = {
+        "welcome": (),
+        "status": (customer.first_name, customer.notification_text, customer.has_full_support, customer.exam_status,
+                   customer.specialty_id, customer.docs_ready, tuple(customer.docs_extra), upload_set),
+        "group": (customer.group_id, customer.has_full_support),
+        "docs": (customer.specialty_id, customer.docs_ready, upload_set),
+        "docs_extra": (docs_extra, upload_set),
+        # Ближайшие события зависят от текущего времени, поэтому берем сами события, а не только версию каталога
+        "events": (customer.group_id, events),
+        "exams": (customer.exam_status, customer.exam_info, customer.exam_datetime),
+        "accounts": (customer.access_info,),
+    }
+    return {name: version_of(name, customer.amo_id, catalog_version, inputs) for name, inputs in sections.items()}
+
 
 @profile_router.get("/lk/{amo_id}")
 @profile_router.get("/profile/{amo_id}")
 async def profile(request: Request, amo_id: int):
     """Вывод главной страницы с профилем"""
-    customer: Customer = await amo_api.fetch_lead_data(amo_id)
+    with span("lead"):
+        customer: Customer = await amo_api.fetch_lead_data(amo_id)
 
     context = {"request": request, "customer": customer, "amo_id": amo_id, "config": gas_api.config}
 
@@ -28,11 +61,22 @@ async def profile(request: Request, amo_id: int):
     customer.docs = gas_api.get_documents_by_indices(specialty_docs, customer.docs_ready)
 
     # Досыпаем пользователю информацию про все загруженные файлы пользователя
-    all_uploads: list[UploadedDocument] = await gas_api.get_all_uploads(amo_id)
+    with span("uploads"):
+        all_uploads: list[UploadedDocument] = await gas_api.get_all_uploads(amo_id)
     customer.set_uploads(all_uploads)
 
-    # Если пользователь не активирован – активируем
+    # Если пользователь не активирован – активируем, не дожидаясь вебхука
     if not customer.is_activated:
-        await amo_reporter.activate(amo_id)
+        with span("activate"):
+            amo_reporter.activate(amo_id)
+
+    versions = section_versions(customer, all_uploads, gas_api.catalog.version)
+    etag = fragment_cache.etag(amo_id, gas_api.catalog.version, versions)
+    headers = {"ETag": etag, "Cache-Control": PROFILE_CACHE_CONTROL}
+
+    # Ничего из выводимого не поменялось – браузер покажет свою копию
+    if etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
 
-    return templates.TemplateResponse("pages/profile.html", context)
+    context["versions"] = versions
+    return templates.TemplateResponse("pages/profile.html", context, headers=headers)
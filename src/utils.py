@@ -1,5 +1,13 @@
 from datetime import datetime
+from functools import lru_cache
+
 import markdown
+from jinja2 import Environment
+
+from config import MARKDOWN_CACHE_SIZE
+
+# Один экземпляр вместо markdown.markdown(): тот на каждый вызов заново создает Markdown и подключает расширения
+_markdown = markdown.Markdown()
 
 
 def format_datetime_ru(value: datetime):
@@ -16,10 +24,37 @@ def format_datetime_ru(value: datetime):
     return f"{day} {month} {year} {hour:02}:{minute:02}"  # Ensure to add time
 
 
+@lru_cache(maxsize=MARKDOWN_CACHE_SIZE)
 def markdown_to_html(markdown_text: str) -> str:
+    """
+    Текст из Kommo (exam_info и т.п.) у многих клиентов одинаковый и меняется редко,
+    поэтому готовый HTML держим в LRU, а не конвертируем на каждый рендер
+    """
     try:
-        html = markdown.markdown(markdown_text)
+        html = _markdown.reset().convert(markdown_text)
         return html
     except Exception as e:
         print(f"Error converting Markdown to HTML: {e}")
         return None
+
+
+def precompile_templates(env: Environment) -> int:
+    """
+    Компилирует все шаблоны при запуске, а не на первых запросах. С кешем байткода на диске
+    компилирует только первый воркер после деплоя, остальные загружают готовый байткод
+    """
+    names = env.list_templates(extensions=["html"])
+    for name in names:
+        env.get_template(name)
+    return len(names)
+
+
+def markdown_cache_stats() -> dict[str, float]:
+    info = markdown_to_html.cache_info()
+    lookups = info.hits + info.misses
+    return {
+        "size": info.currsize,
+        "hits_total": info.hits,
+        "misses_total": info.misses,
+        "hit_ratio": round(info.hits / lookups, 4) if lookups else 0.0,
+    }